@@ -1,3 +1,4 @@
+import inspect
 import os
 import sys
 import openvino as ov
@@ -9,7 +10,9 @@ import argparse
 
 utils_file_path = Path('.')
 sys.path.append(str(utils_file_path))
-from utils import flattenize_inputs
+from utils import (COMPRESSION_MODES, add_topk_head, compress_model,
+                   flattenize_inputs, slice_last_token,
+                   write_compression_summary)
 
 ir_model_path = Path('baichuan2') / Path('ir_model')
 if ir_model_path.exists() == False:
@@ -29,21 +32,38 @@ parser.add_argument('-m',
                     help='orignal model path')
 parser.add_argument('-cw',
                     '--compress_weight',
-                    default=False,
+                    default=None,
                     required=False,
-                    type=bool,
-                    help='Weights Compression')
+                    choices=COMPRESSION_MODES,
+                    help='Optional. weights compression mode')
+parser.add_argument('-gs',
+                    '--group_size',
+                    default=128,
+                    required=False,
+                    type=int,
+                    help='Optional. number of weights sharing one scale in the int4 modes')
+parser.add_argument('-r',
+                    '--ratio',
+                    default=1.0,
+                    required=False,
+                    type=float,
+                    help='Optional. fraction of the layers compressed to int4 in the int4 modes, the rest is int8')
+parser.add_argument('-lt',
+                    '--last_token_logits',
+                    action='store_true',
+                    help='Optional. compute the logits of the last position only, which saves the lm_head matmul and logits buffer of every other prompt token; not usable with speculative decoding')
+parser.add_argument('-k',
+                    '--topk_head',
+                    default=None,
+                    required=False,
+                    type=int,
+                    help='Optional. return only the k largest logits and their token ids, which cuts the logits readback of every step; not usable with speculative decoding')
 args = parser.parse_args()
 
 model = AutoModelForCausalLM.from_pretrained(args.model_id,
                                              device_map="auto",
                                              trust_remote_code=True).eval()
 
-if args.compress_weight == True:
-    print("--- compress weight ---")
-    from nncf import compress_weights
-    model = compress_weights(model)
-
 # Specify hyperparameters for generation
 model.generation_config = GenerationConfig.from_pretrained(
     args.model_id, trust_remote_code=True)
@@ -56,25 +76,36 @@ outputs = ["logits"]
 
 dynamic_shapes = {
     "input_ids": {
+        0: "batch_size",
         1: "seq_len"
     },
     "attention_mask": {
+        0: "batch_size",
         1: "seq_len"
     }
 }
 inputs.append("attention_mask")
+# per-row positions let batched sequences of different lengths share a
+# KV-cache, see BatchScheduler
+use_position_ids = "position_ids" in inspect.signature(
+    model.forward).parameters
+if use_position_ids:
+    inputs.append("position_ids")
+    dynamic_shapes["position_ids"] = {0: "batch_size", 1: "seq_len"}
 for idx in range(len(outs.past_key_values)):
     inputs.extend(
         [f"past_key_values.{idx}.key", f"past_key_values.{idx}.value"])
-    dynamic_shapes[inputs[-1]] = {2: "past_sequence + 1"}
-    dynamic_shapes[inputs[-2]] = {2: "past_sequence + 1"}
+    dynamic_shapes[inputs[-1]] = {0: "batch_size", 2: "past_sequence + 1"}
+    dynamic_shapes[inputs[-2]] = {0: "batch_size", 2: "past_sequence + 1"}
     outputs.extend([f"present.{idx}.key", f"present.{idx}.value"])
 
 dummy_inputs = {
     "input_ids": torch.ones((1, 2), dtype=torch.long),
     "attention_mask": torch.ones((1, 12), dtype=torch.long),
-    "past_key_values": outs.past_key_values
 }
+if use_position_ids:
+    dummy_inputs["position_ids"] = torch.tensor([[10, 11]], dtype=torch.long)
+dummy_inputs["past_key_values"] = outs.past_key_values
 model.config.torchscript = True
 
 print("====Exporting IR=====")
@@ -95,7 +126,22 @@ for out, out_name in zip(ov_model.outputs, outputs):
     out.get_tensor().set_names({out_name})
 
 ov_model.validate_nodes_and_infer_types()
+if args.compress_weight:
+    print("--- compress weight ---")
+    ov_model = compress_model(ov_model, args.compress_weight,
+                              args.group_size, args.ratio)
+if args.last_token_logits:
+    print("--- slice logits to the last token ---")
+    slice_last_token(ov_model, seq_axis=1)
+if args.topk_head:
+    print("--- add top-k head ---")
+    ov_model = add_topk_head(ov_model, args.topk_head)
 ov.save_model(ov_model, ir_model)
+if args.compress_weight:
+    write_compression_summary(ir_model,
+                              mode=args.compress_weight,
+                              group_size=args.group_size,
+                              ratio=args.ratio)
 
 print("====Exporting tokenizer=====")
 from transformers import AutoTokenizer
@@ -0,0 +1,326 @@
+import argparse
+import gc
+import itertools
+import json
+import platform
+import threading
+import time
+
+import numpy as np
+from openvino.runtime import get_version
+
+from chatglm2.modeling import ChatGLMModel
+from qwen.modeling import QwenModel
+from baichuan2.modeling import BaichuanModel
+from internlm.modeling import InternLMModel
+from runtime import (RuntimeConfig, add_runtime_args, memory_usage,
+                     reset_peak_rss)
+from scheduler import BatchScheduler, GenerationTask
+from synthetic import load_tokenizer
+
+FILLER_TEXT = "上海是中国的经济中心，也是一座历史悠久的国际化大都市。"
+COMPARED_METRICS = ("ttft_ms.p50", "decode_latency_ms.p50",
+                    "decode_latency_ms.p99", "throughput_tokens_per_s",
+                    "peak_rss_mb")
+
+
+def load_chat_model(model_id: str, args, config: RuntimeConfig):
+    if 'chatglm2' in model_id:
+        model_class = ChatGLMModel
+    elif 'qwen' in model_id:
+        model_class = QwenModel
+    elif 'baichuan2' in model_id:
+        model_class = BaichuanModel
+    elif 'internlm' in model_id:
+        model_class = InternLMModel
+    else:
+        raise NotImplementedError(f"Unsupported model id {model_id!r}")
+    return model_class(model_id,
+                       args.device,
+                       num_requests=args.num_requests,
+                       cache_dir=args.cache_dir,
+                       config=config,
+                       tokenizer=load_tokenizer(model_id))
+
+
+def make_prompt(tokenizer, length: int):
+    """
+    Token ids of exactly `length` tokens of filler text
+    """
+    text = FILLER_TEXT
+    input_ids = tokenizer([text], return_tensors="np")['input_ids']
+    while input_ids.shape[1] < length:
+        text *= 2
+        input_ids = tokenizer([text], return_tensors="np")['input_ids']
+    return np.asarray(input_ids[:, :length], dtype=np.int64)
+
+
+def percentiles(values):
+    if not len(values):
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+
+def run_generate(engine, input_ids, output_length: int):
+    """
+    One sequence through `GenerationEngine.generate`, returns the time of
+    the request and of every token
+    """
+    start = time.perf_counter()
+    token_times = []
+    for _ in engine.generate(input_ids, output_length):
+        token_times.append(time.perf_counter())
+    return [(start, token_times)]
+
+
+def run_batch(engine, input_ids, output_length: int, batch_size: int):
+    """
+    `batch_size` sequences decoded together by a `BatchScheduler`
+    """
+    token_times = {}
+    scheduler = BatchScheduler(engine, batch_size)
+    start = time.perf_counter()
+    for _ in range(batch_size):
+        task = GenerationTask(
+            input_ids,
+            output_length,
+            on_token=lambda task, token: token_times[id(task)].append(
+                time.perf_counter()))
+        token_times[id(task)] = []
+        scheduler.submit(task)
+    scheduler.run()
+    return [(start, times) for times in token_times.values()]
+
+
+def run_scenario(ov_model, prompt_length: int, output_length: int,
+                 batch_size: int, concurrency: int, num_runs: int):
+    """
+    Runs `concurrency` workers in parallel, each generating `batch_size`
+    sequences, `num_runs` times and returns the latency statistics and the
+    peak RSS of the scenario, None where it cannot be measured separately
+    """
+    engine = ov_model.engine
+    # the peak of this scenario, not the running maximum since load
+    per_scenario_rss = reset_peak_rss()
+    input_ids = make_prompt(ov_model.tokenizer, prompt_length)
+    ttft, decode_latency = [], []
+    num_tokens, wall_time = 0, 0.0
+    for _ in range(num_runs):
+        results = []
+
+        def worker():
+            if batch_size == 1:
+                sequences = run_generate(engine, input_ids, output_length)
+            else:
+                sequences = run_batch(engine, input_ids, output_length,
+                                      batch_size)
+            results.extend(sequences)
+
+        workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        wall_time += time.perf_counter() - start
+        for request_start, token_times in results:
+            if not token_times:
+                continue
+            num_tokens += len(token_times)
+            ttft.append(token_times[0] - request_start)
+            decode_latency.extend(np.diff(token_times))
+    peak_rss = memory_usage()["peak_rss"] if per_scenario_rss else None
+    return {
+        "prompt_length": prompt_length,
+        "output_length": output_length,
+        "batch_size": batch_size,
+        "concurrency": concurrency,
+        "num_runs": num_runs,
+        "generated_tokens": num_tokens,
+        "ttft_ms": percentiles(ttft),
+        "decode_latency_ms": percentiles(decode_latency),
+        "throughput_tokens_per_s": num_tokens / wall_time,
+        "peak_rss_mb": peak_rss / (1 << 20) if peak_rss is not None else None,
+    }
+
+
+def benchmark_model(model_id: str, args, config: RuntimeConfig):
+    reset_peak_rss()
+    ov_model = load_chat_model(model_id, args, config)
+    # generation has to run to the requested length
+    ov_model.engine.adapter.stop_token_ids = set()
+    ov_model.engine.prefill_chunk_size = args.prefill_chunk_size
+    profiler = ov_model.engine.profiler
+    profiler.enabled = args.profile
+    print(" --- warming up --- ")
+    run_generate(ov_model.engine,
+                 make_prompt(ov_model.tokenizer, min(args.prompt_lengths)), 2)
+    result = {
+        "model": model_id,
+        "load": ov_model.load_timings.as_dict(),
+        "scenarios": [],
+    }
+    scenarios = itertools.product(args.prompt_lengths, args.output_lengths,
+                                  args.batch_sizes, args.concurrency)
+    for prompt_length, output_length, batch_size, concurrency in scenarios:
+        print(f" --- {model_id}: prompt {prompt_length}, output "
+              f"{output_length}, batch {batch_size}, concurrency "
+              f"{concurrency} --- ")
+        profiler.reset()
+        scenario = run_scenario(ov_model, prompt_length, output_length,
+                                batch_size, concurrency, args.num_runs)
+        if profiler.enabled:
+            scenario["profile"] = profiler.summary()
+        print(f"TTFT {scenario['ttft_ms']['p50']:.1f} ms, decode "
+              f"{scenario['decode_latency_ms']['p50']:.1f} ms/token, "
+              f"{scenario['throughput_tokens_per_s']:.2f} tokens/s")
+        result["scenarios"].append(scenario)
+    del ov_model
+    gc.collect()
+    return result
+
+
+def scenario_key(model, scenario):
+    return (model, scenario["prompt_length"], scenario["output_length"],
+            scenario["batch_size"], scenario["concurrency"])
+
+
+def metric(scenario, name):
+    value = scenario
+    for key in name.split("."):
+        value = value.get(key) if value is not None else None
+    return value
+
+
+def compare(results, baseline):
+    """
+    Prints the relative change of the main metrics against a previous run
+    """
+    previous = {
+        scenario_key(model["model"], scenario): scenario
+        for model in baseline["results"] for scenario in model["scenarios"]
+    }
+    for model in results["results"]:
+        for scenario in model["scenarios"]:
+            key = scenario_key(model["model"], scenario)
+            if key not in previous:
+                continue
+            changes = []
+            for name in COMPARED_METRICS:
+                old, new = metric(previous[key], name), metric(scenario, name)
+                if old and new is not None:
+                    changes.append(f"{name} {100 * (new - old) / old:+.1f}%")
+            print(f"{key}: {', '.join(changes)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h',
+                        '--help',
+                        action='help',
+                        help='Show this help message and exit.')
+    parser.add_argument('-m',
+                        '--model_path',
+                        required=True,
+                        nargs='+',
+                        type=str,
+                        help='Required. one or more model paths')
+    parser.add_argument('-d',
+                        '--device',
+                        default='CPU',
+                        required=False,
+                        type=str,
+                        help='Required. device for inference')
+    parser.add_argument('-p',
+                        '--prompt_lengths',
+                        default=[32, 512],
+                        nargs='+',
+                        type=int,
+                        help='Optional. prompt lengths in tokens')
+    parser.add_argument('-l',
+                        '--output_lengths',
+                        default=[128],
+                        nargs='+',
+                        type=int,
+                        help='Optional. generated tokens per sequence')
+    parser.add_argument('-b',
+                        '--batch_sizes',
+                        default=[1],
+                        nargs='+',
+                        type=int,
+                        help='Optional. sequences decoded together by the batch scheduler')
+    parser.add_argument('-n',
+                        '--concurrency',
+                        default=[1],
+                        nargs='+',
+                        type=int,
+                        help='Optional. independent generations running in parallel')
+    parser.add_argument('-r',
+                        '--num_runs',
+                        default=3,
+                        required=False,
+                        type=int,
+                        help='Optional. repetitions of every scenario')
+    parser.add_argument('-nr',
+                        '--num_requests',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. number of infer requests, defaults to the optimal number of the compiled model')
+    parser.add_argument('-pf',
+                        '--prefill_chunk_size',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. longest prompt part prefilled in one inference, caps the memory of long prompts')
+    parser.add_argument('-c',
+                        '--cache_dir',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. directory caching the compiled model to cut start-up time')
+    parser.add_argument('-o',
+                        '--output',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. JSON file to write the results to')
+    parser.add_argument('--baseline',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. JSON results of a previous run to compare against')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Optional. add the time spent in every phase of a step to the results')
+    add_runtime_args(parser)
+    args = parser.parse_args()
+    config = RuntimeConfig.from_args(args)
+
+    results = {
+        "openvino": get_version(),
+        "device": args.device,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "runtime_config": config.properties(),
+        "prefill_chunk_size": args.prefill_chunk_size,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": [
+            benchmark_model(model_id, args, config)
+            for model_id in args.model_path
+        ],
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            compare(results, json.load(baseline_file))
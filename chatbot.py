@@ -4,7 +4,15 @@ from chatglm2.modeling import ChatGLMModel
 from qwen.modeling import QwenModel
 from baichuan2.modeling import BaichuanModel
 from internlm.modeling import InternLMModel
+from synthetic import load_tokenizer
+from engine import ChatSession
+from kv_cache import KVBlockPool, KVCacheExhausted, PrefixCache
+from metrics import (GenerationMetrics, MetricsRegistry, add_process_metrics,
+                     serve_metrics)
+from runtime import (RuntimeConfig, add_runtime_args, format_memory,
+                     memory_usage)
 import argparse
+import weakref
 
 
 @st.cache_resource
@@ -25,19 +33,81 @@ def create_model():
                         required=False,
                         type=str,
                         help='Required. device for inference')
+    parser.add_argument('-pc',
+                        '--prefix_cache_size',
+                        default=1024,
+                        required=False,
+                        type=int,
+                        help='Optional. memory budget in MB of the KV-cache kept for shared prompt prefixes, 0 disables it')
+    parser.add_argument('-kv',
+                        '--kv_pool_size',
+                        default=4096,
+                        required=False,
+                        type=int,
+                        help='Optional. memory budget in MB of the paged KV-cache shared by all chat sessions, idle sessions are evicted least recently used first when it runs out; 0 disables it')
+    parser.add_argument('-nr',
+                        '--num_requests',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. number of infer requests serving chat sessions in parallel, defaults to the optimal number of the compiled model')
+    parser.add_argument('-c',
+                        '--cache_dir',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. directory caching the compiled model to cut start-up time')
+    parser.add_argument('-pf',
+                        '--prefill_chunk_size',
+                        default=512,
+                        required=False,
+                        type=int,
+                        help='Optional. longest prompt part prefilled in one inference, caps the memory of long conversations')
+    parser.add_argument('--no_mmap',
+                        action='store_true',
+                        help='Optional. read the weights into process memory instead of memory mapping them')
+    parser.add_argument('--metrics_port',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. serve Prometheus metrics on http://127.0.0.1:<port>/metrics')
+    add_runtime_args(parser)
     
     args = parser.parse_args()
+    config = RuntimeConfig.from_args(args)
     model_id = args.model_path
+    prefix_cache = None
+    if args.prefix_cache_size > 0:
+        prefix_cache = PrefixCache(max_bytes=args.prefix_cache_size << 20)
+    kv_pool = None
+    if args.kv_pool_size > 0:
+        kv_pool = KVBlockPool(max_bytes=args.kv_pool_size << 20)
+    tokenizer = load_tokenizer(model_id)
     if 'chatglm2' in model_id:
-        ov_model = ChatGLMModel(model_id, args.device)
+        ov_model = ChatGLMModel(model_id, args.device, prefix_cache, kv_pool,
+                                args.num_requests, args.cache_dir,
+                                not args.no_mmap, config, tokenizer)
     elif 'qwen' in model_id:
-        ov_model = QwenModel(model_id, args.device)
+        ov_model = QwenModel(model_id, args.device, prefix_cache, kv_pool,
+                             args.num_requests, args.cache_dir,
+                             not args.no_mmap, config, tokenizer)
     elif 'baichuan2' in model_id:
-        ov_model = BaichuanModel(model_id, args.device)
+        ov_model = BaichuanModel(model_id, args.device, prefix_cache, kv_pool,
+                                 args.num_requests, args.cache_dir,
+                                 not args.no_mmap, config, tokenizer)
     elif 'internlm' in model_id:
-        ov_model = InternLMModel(model_id, args.device)
+        ov_model = InternLMModel(model_id, args.device, prefix_cache, kv_pool,
+                                 args.num_requests, args.cache_dir,
+                                 not args.no_mmap, config, tokenizer)
     else:
         raise NotImplementedError(f"Unsupported model id {model_id!r}")
+    ov_model.engine.prefill_chunk_size = args.prefill_chunk_size
+    print(f" --- {ov_model.load_timings.report()} --- ")
+    print(f" --- {format_memory(memory_usage())} --- ")
+    if args.metrics_port is not None:
+        registry = add_process_metrics(MetricsRegistry())
+        GenerationMetrics(registry).attach(ov_model.engine)
+        serve_metrics(registry, args.metrics_port)
     return ov_model
 
 
@@ -46,6 +116,14 @@ with st.spinner("加载模型中..."):
 
 if 'history' not in st.session_state:
     st.session_state.history = []
+if 'chat_session' not in st.session_state:
+    st.session_state.chat_session = ChatSession()
+    if chat_model.engine.metrics is not None:
+        # sessions are dropped with the browser session state
+        sessions = chat_model.engine.metrics.registry.gauge(
+            "ov_chat_sessions", "Chat sessions of connected browsers")
+        sessions.inc()
+        weakref.finalize(st.session_state.chat_session, sessions.dec)
 
 with st.sidebar:
     system = st.text_area("系统提示词", value="你是一个友好、诚实、善良的聊天助手，可以回答任何问题")
@@ -64,6 +142,10 @@ with st.sidebar:
     if st.button("清空上下文"):
         st.session_state.message = ""
         st.session_state.history = []
+        st.session_state.chat_session.reset()
+    if chat_model.engine.kv_pool is not None:
+        usage = chat_model.engine.kv_pool.usage()
+        st.caption(f"KV-cache: {usage['used_blocks']}/{usage['total_blocks']} blocks")
 
 st.markdown("## OpenVINO中文聊天助手")
 
@@ -86,15 +168,25 @@ if st.button("发送") and len(question.strip()):
         message(question, is_user=True, key="message_question")
         with st.spinner("正在回复中"):
             with st.empty():
-                prompt_token = chat_model.build_inputs(history, question, system)
-                for answer in chat_model.generate_iterate(
-                        prompt_token,
-                        max_generated_tokens=max_tokens,
-                        top_k=top_k,
-                        top_p=top_p,
-                        temperature=temperature,
-                ):
-                    st.write(answer)
+                prompt_token = chat_model.build_inputs(
+                    history,
+                    question,
+                    system,
+                    max_generated_tokens=max_tokens)
+                answer = None
+                try:
+                    for answer in chat_model.generate_iterate(
+                            prompt_token,
+                            max_generated_tokens=max_tokens,
+                            top_k=top_k,
+                            top_p=top_p,
+                            temperature=temperature,
+                            session=st.session_state.chat_session,
+                    ):
+                        st.write(answer)
+                except KVCacheExhausted:
+                    st.error("服务器繁忙，请稍后再试")
         st.markdown("---")
 
-    st.session_state.history = history + [(question, answer)]
+    if answer is not None:
+        st.session_state.history = history + [(question, answer)]
@@ -8,7 +8,9 @@ import argparse
 
 utils_file_path = Path('.')
 sys.path.append(str(utils_file_path))
-from utils import flattenize_inputs
+from utils import (COMPRESSION_MODES, add_topk_head, compress_model,
+                   flattenize_inputs, slice_last_token,
+                   write_compression_summary)
 
 ir_model_path = Path('chatglm2') / Path('ir_model')
 if ir_model_path.exists() == False:
@@ -28,10 +30,32 @@ parser.add_argument('-m',
                     help='orignal model path')
 parser.add_argument('-cw',
                     '--compress_weight',
-                    default=False,
+                    default=None,
                     required=False,
-                    type=bool,
-                    help='Weights Compression')
+                    choices=COMPRESSION_MODES,
+                    help='Optional. weights compression mode')
+parser.add_argument('-gs',
+                    '--group_size',
+                    default=128,
+                    required=False,
+                    type=int,
+                    help='Optional. number of weights sharing one scale in the int4 modes')
+parser.add_argument('-r',
+                    '--ratio',
+                    default=1.0,
+                    required=False,
+                    type=float,
+                    help='Optional. fraction of the layers compressed to int4 in the int4 modes, the rest is int8')
+parser.add_argument('-lt',
+                    '--last_token_logits',
+                    action='store_true',
+                    help='Optional. compute the logits of the last position only, which saves the lm_head matmul and logits buffer of every other prompt token; not usable with speculative decoding')
+parser.add_argument('-k',
+                    '--topk_head',
+                    default=None,
+                    required=False,
+                    type=int,
+                    help='Optional. return only the k largest logits and their token ids, which cuts the logits readback of every step; not usable with speculative decoding')
 args = parser.parse_args()
 
 model = AutoModel.from_pretrained(args.model_id,
@@ -44,18 +68,22 @@ outs = model(input_ids=torch.ones((1, 10), dtype=torch.long),
 inputs = ["input_ids"]
 outputs = ["logits"]
 
-if args.compress_weight == True:
-    print("--- compress weight ---")
-    from nncf import compress_weights
-    model = compress_weights(model)
-
-dynamic_shapes = {"input_ids": {1: "seq_len"}, "position_ids": {1: "seq_len"}}
+dynamic_shapes = {
+    "input_ids": {
+        0: "batch_size",
+        1: "seq_len"
+    },
+    "position_ids": {
+        0: "batch_size",
+        1: "seq_len"
+    }
+}
 inputs.append("position_ids")
 for idx in range(len(outs.past_key_values)):
     inputs.extend(
         [f"past_key_values.{idx}.key", f"past_key_values.{idx}.value"])
-    dynamic_shapes[inputs[-1]] = {0: "past_sequence + 1"}
-    dynamic_shapes[inputs[-2]] = {0: "past_sequence + 1"}
+    dynamic_shapes[inputs[-1]] = {0: "past_sequence + 1", 1: "batch_size"}
+    dynamic_shapes[inputs[-2]] = {0: "past_sequence + 1", 1: "batch_size"}
     outputs.extend([f"present.{idx}.key", f"present.{idx}.value"])
 
 dummy_inputs = {
@@ -83,7 +111,23 @@ for out, out_name in zip(ov_model.outputs, outputs):
     out.get_tensor().set_names({out_name})
 
 ov_model.validate_nodes_and_infer_types()
+if args.compress_weight:
+    print("--- compress weight ---")
+    ov_model = compress_model(ov_model, args.compress_weight,
+                              args.group_size, args.ratio)
+if args.last_token_logits:
+    print("--- slice logits to the last token ---")
+    # the hidden states are [seq_len, batch_size, hidden_size]
+    slice_last_token(ov_model, seq_axis=0)
+if args.topk_head:
+    print("--- add top-k head ---")
+    ov_model = add_topk_head(ov_model, args.topk_head)
 ov.save_model(ov_model, ir_model)
+if args.compress_weight:
+    write_compression_summary(ir_model,
+                              mode=args.compress_weight,
+                              group_size=args.group_size,
+                              ratio=args.ratio)
 
 print("====Exporting tokenizer=====")
 from transformers import AutoTokenizer
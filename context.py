@@ -0,0 +1,170 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ContextWindow():
+    """
+    Assembles prompts from pieces: the tokens the tokenizer adds in front of
+    every text, the system prompt, one piece per past (query, answer) turn
+    and the new query. The token count of every text piece is cached, so
+    fitting a growing chat into the budget only tokenizes its newest turn
+    on its own.
+
+    Prompts longer than the token budget lose whole turns, oldest first; the
+    system prompt is kept and the query only loses its start when it does not
+    fit on its own.
+    """
+
+    def __init__(self, tokenizer, max_cache_size: int = 4096) -> None:
+        self.tokenizer = tokenizer
+        self.max_cache_size = max_cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # e.g. [gMASK] sop of ChatGLM2 or the BOS token of InternLM
+        self.prefix = self._tokenize("", add_special_tokens=True)
+
+    def _tokenize(self, text: str, add_special_tokens: bool = False):
+        input_ids = self.tokenizer([text],
+                                   add_special_tokens=add_special_tokens,
+                                   return_tensors="np")['input_ids']
+        return np.asarray(input_ids[0], dtype=np.int64)
+
+    def encode(self, text: str):
+        """
+        Token ids of `text` without special tokens, cached
+        """
+        with self._lock:
+            input_ids = self._cache.get(text)
+            if input_ids is not None:
+                self._cache.move_to_end(text)
+                return input_ids
+        input_ids = self._tokenize(text)
+        with self._lock:
+            self._cache[text] = input_ids
+            while len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+        return input_ids
+
+    def _length(self, piece):
+        if isinstance(piece, str):
+            return len(self.encode(piece))
+        return len(piece)
+
+    def build(self,
+              system,
+              turns,
+              query,
+              max_input_tokens: int,
+              max_generated_tokens: int = 0,
+              lone_query=None):
+        """
+        Returns the `[1, num_tokens]` prompt of the system prompt, as many of
+        the most recent turns as fit and the query. `lone_query` replaces
+        `query` when no turn is kept, for chat formats that open the first
+        turn differently.
+
+        Pieces are either texts or token ids. Texts are only tokenized
+        separately to measure them, the kept ones are joined and tokenized
+        as one string, so merges across piece boundaries and the dummy
+        prefix of SentencePiece tokenizers come out exactly as for the whole
+        prompt. Token id pieces are concatenated as they are.
+
+        The prompt and the `max_generated_tokens` of the answer never
+        exceed `max_input_tokens` together. Turns are dropped first, the
+        system prompt is always kept and the query only loses its start
+        when it does not fit on its own. Raises ValueError when the system
+        prompt and the answer leave no room for any query token.
+        """
+        if lone_query is None:
+            lone_query = query
+        text = isinstance(query, str)
+        budget = max_input_tokens - max_generated_tokens
+        fixed_length = len(self.prefix) + self._length(system)
+        if fixed_length >= budget:
+            raise self._no_room(fixed_length, max_input_tokens,
+                                max_generated_tokens)
+        if fixed_length + self._length(lone_query) > budget:
+            # not even the query fits, keep its end
+            return self._truncate(system, lone_query, max_input_tokens,
+                                  max_generated_tokens)
+        length = fixed_length + self._length(query)
+        kept = []
+        for turn in reversed(turns):
+            turn_length = self._length(turn)
+            if length + turn_length > budget:
+                break
+            length += turn_length
+            kept.append(turn)
+        kept.reverse()
+        while True:
+            pieces = [system] + kept + [query if kept else lone_query]
+            if not text:
+                return np.concatenate(
+                    [self.prefix] +
+                    [np.asarray(ids, dtype=np.int64) for ids in pieces])[None]
+            input_ids = self._tokenize("".join(pieces),
+                                       add_special_tokens=True)
+            # the whole prompt may tokenize longer than its pieces
+            if len(input_ids) <= budget:
+                return input_ids[None]
+            if not kept:
+                return self._truncate(system, lone_query, max_input_tokens,
+                                      max_generated_tokens)
+            kept.pop(0)
+
+    def _truncate(self, system, query, max_input_tokens: int,
+                  max_generated_tokens: int):
+        if isinstance(query, str):
+            head = self._tokenize(system, add_special_tokens=True)
+            query = self.encode(query)
+        else:
+            head = np.concatenate(
+                (self.prefix, np.asarray(system, dtype=np.int64)))
+        keep = max_input_tokens - max_generated_tokens - len(head)
+        if keep < 1:
+            raise self._no_room(len(head), max_input_tokens,
+                                max_generated_tokens)
+        return np.concatenate(
+            (head, np.asarray(query[len(query) - keep:], dtype=np.int64)))[None]
+
+    @staticmethod
+    def _no_room(fixed_length: int, max_input_tokens: int,
+                 max_generated_tokens: int):
+        return ValueError(
+            f"the system prompt takes {fixed_length} and the answer "
+            f"{max_generated_tokens} of the {max_input_tokens} tokens, none "
+            f"are left for the query")
+
+
+def messages_to_history(messages):
+    """
+    Splits OpenAI style chat messages into the system prompt, the
+    (query, answer) history and the last user query the model classes take
+    """
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("'messages' must be a non-empty list")
+    system = ""
+    history = []
+    query = None
+    for message in messages:
+        if not isinstance(message, dict):
+            raise ValueError("every message must be an object")
+        role, content = message.get("role"), message.get("content")
+        if not isinstance(content, str):
+            raise ValueError("message 'content' must be a string")
+        if role == "system":
+            system = content
+        elif role == "user":
+            if query is not None:
+                history.append((query, ""))
+            query = content
+        elif role == "assistant":
+            history.append((query or "", content))
+            query = None
+        else:
+            raise ValueError(f"Unsupported message role {role!r}")
+    if query is None:
+        raise ValueError("the last message must come from the user")
+    return system, history, query
@@ -0,0 +1,737 @@
+import queue
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from openvino.runtime import Tensor
+
+from kv_cache import (BlockTable, KVBlockPool, KVCacheBuffer, KVCacheExhausted,
+                      PrefixCache)
+from profiler import Profiler
+from utils import (BatchSampler, IncrementalDetokenizer,
+                   IncrementalResponseProcessor, TopKLogits, process_response)
+
+
+class ModelAdapter():
+    """
+    Describes the per-family differences the generation loop has to know about:
+    where the sequence and batch dimensions live in the KV-cache tensors,
+    whether the graph takes `position_ids` or `attention_mask`, how the
+    model signals the end of an answer and how many positions it was trained
+    on.
+    """
+
+    def __init__(self,
+                 kv_seq_axis: int,
+                 kv_batch_axis: int = 0,
+                 stop_token_ids=(),
+                 use_position_ids: bool = False,
+                 use_attention_mask: bool = False,
+                 stop_text: str = None,
+                 context_length: int = None) -> None:
+        self.kv_seq_axis = kv_seq_axis
+        self.kv_batch_axis = kv_batch_axis
+        self.stop_token_ids = set(stop_token_ids)
+        self.use_position_ids = use_position_ids
+        self.use_attention_mask = use_attention_mask
+        self.stop_text = stop_text
+        self.context_length = context_length
+
+    def is_stop_token(self, token_id: int):
+        return token_id in self.stop_token_ids
+
+    def postprocess(self, text: str):
+        text = process_response(text)
+        if self.stop_text is not None:
+            text = text.split(self.stop_text)[0]
+        return text
+
+
+class ChatSession():
+    """
+    KV-cache of one conversation kept between turns. `tokens` are the ids the
+    cached `past_key_values` cover, so the next turn only has to prefill the
+    part of its prompt that differs from them. With a `KVBlockPool` the
+    KV-cache is a `BlockTable` whose blocks go back to the pool on `reset`,
+    when the session is garbage collected or when the engine evicts it
+    between turns to make room for other sequences.
+    """
+
+    def __init__(self) -> None:
+        self.tokens = np.zeros((0, ), dtype=np.int64)
+        self.past_key_values = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __del__(self):
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            if isinstance(self.past_key_values, BlockTable):
+                self.past_key_values.release()
+            self.tokens = np.zeros((0, ), dtype=np.int64)
+            self.past_key_values = None
+
+    def common_prefix_length(self, input_ids):
+        length = min(len(self.tokens), len(input_ids))
+        mismatch = np.flatnonzero(self.tokens[:length] != input_ids[:length])
+        return int(mismatch[0]) if len(mismatch) else length
+
+
+class InferRequestPool():
+    """
+    Infer requests of one compiled model shared by concurrent generations,
+    each generation checks a request out for as long as it runs. The default
+    size is the OPTIMAL_NUMBER_OF_INFER_REQUESTS of the compiled model, i.e.
+    the number of streams it was compiled with.
+    """
+
+    def __init__(self, compiled_model, num_requests: int = None) -> None:
+        if num_requests is None:
+            num_requests = compiled_model.get_property(
+                "OPTIMAL_NUMBER_OF_INFER_REQUESTS")
+        self.compiled_model = compiled_model
+        self.num_requests = num_requests
+        self._requests = queue.LifoQueue()
+        for _ in range(num_requests):
+            self._requests.put(compiled_model.create_infer_request())
+
+    def __len__(self):
+        return self.num_requests
+
+    @property
+    def num_free(self):
+        return self._requests.qsize()
+
+    def acquire(self, timeout: float = None):
+        """
+        Blocks until a request is free, raises `queue.Empty` after `timeout`
+        """
+        return self._requests.get(timeout=timeout)
+
+    def release(self, request):
+        self._requests.put(request)
+
+    @contextmanager
+    def checkout(self, timeout: float = None):
+        request = self.acquire(timeout)
+        try:
+            yield request
+        finally:
+            self.release(request)
+
+
+class GenerationEngine():
+    """
+    Model independent decode loop driving OpenVINO infer requests with
+    explicit `past_key_values.*` inputs and `present.*` outputs. Requests
+    come from an `InferRequestPool`, so independent generations can run in
+    parallel on one compiled model.
+    """
+
+    def __init__(self,
+                 model,
+                 requests: InferRequestPool,
+                 tokenizer,
+                 adapter: ModelAdapter,
+                 prefix_cache: PrefixCache = None,
+                 kv_pool: KVBlockPool = None,
+                 seed: int = None) -> None:
+        self.model = model
+        self.requests = requests
+        self.tokenizer = tokenizer
+        self.adapter = adapter
+        self.prefix_cache = prefix_cache
+        self.kv_pool = kv_pool
+        self.sampler = BatchSampler(seed)
+        # optional speculative decoding drafter, see speculative.py
+        self.drafter = None
+        # optional runtime.LoadTimings receiving the first inference time
+        self.load_timings = None
+        # times the phases of every step once enabled
+        self.profiler = Profiler()
+        # optional metrics.GenerationMetrics, set by its `attach`
+        self.metrics = None
+        # longest prompt part fed in one forward pass, None for no limit
+        self.prefill_chunk_size = None
+        # KV-cache buffers reused by consecutive generations, at most one per
+        # infer request; longer ones are freed after their generation
+        self.max_kv_buffer_length = 1024
+        self._kv_buffers = []
+        # weak references to the sessions holding a BlockTable, least
+        # recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        # input & output names
+        input_names = [key.get_any_name() for key in model.inputs]
+        output_names = [key.get_any_name() for key in model.outputs]
+        self.key_value_input_names = [
+            key for key in input_names if "key_values" in key
+        ]
+        if not self.key_value_input_names:
+            # e.g. the KV-cache kept as ReadValue/Assign state
+            raise ValueError(
+                "the model has no past_key_values inputs, export it with "
+                "the export_ir.py of its family")
+        self.key_value_output_names = [
+            key for key in output_names if "present" in key
+        ]
+        # attention_mask models exported with position_ids derive every
+        # row's positions from its own mask instead of the KV-cache length
+        self.row_positions = (adapter.use_attention_mask
+                              and "position_ids" in input_names)
+        # exported with --topk_head, see utils.add_topk_head
+        self.topk_logits = "topk_indices" in output_names
+        logits_name = "topk_logits" if self.topk_logits else "logits"
+        # exported with --last_token_logits, see utils.slice_last_token
+        logits_length = model.output(logits_name).get_partial_shape()[1]
+        self.last_token_logits = (logits_length.is_static
+                                  and logits_length.get_length() == 1)
+        if kv_pool is not None:
+            kv_pool.attach(self)
+
+    def kv_shape(self, input_name: str, batch_size: int, length: int):
+        shape = self.model.input(input_name).get_partial_shape()
+        if shape[self.adapter.kv_batch_axis].is_dynamic:
+            shape[self.adapter.kv_batch_axis] = batch_size
+        if shape[self.adapter.kv_seq_axis].is_dynamic:
+            shape[self.adapter.kv_seq_axis] = length
+        return list(shape.get_shape())
+
+    def empty_past(self, batch_size: int = 1, length: int = 0):
+        """
+        Zero filled KV-cache tensors, zero-length ones are used for the first
+        forward pass
+        """
+        past_key_values = {}
+        for input_name in self.key_value_input_names:
+            past = Tensor(self.model.input(input_name).get_element_type(),
+                          self.kv_shape(input_name, batch_size, length))
+            if length:
+                past.data[:] = 0
+            past_key_values[input_name] = past
+        return past_key_values
+
+    def acquire_kv_buffer(self, capacity: int):
+        with self._lock:
+            kv_buffer = self._kv_buffers.pop() if self._kv_buffers else None
+        if kv_buffer is None:
+            return KVCacheBuffer(self, capacity=capacity)
+        kv_buffer.reserve(capacity)
+        return kv_buffer
+
+    def release_kv_buffer(self, kv_buffer: KVCacheBuffer):
+        if kv_buffer.capacity > self.max_kv_buffer_length:
+            return
+        with self._lock:
+            if len(self._kv_buffers) < len(self.requests):
+                self._kv_buffers.append(kv_buffer)
+
+    @property
+    def full_logits(self):
+        return not (self.last_token_logits or self.topk_logits)
+
+    @property
+    def supports_batching(self):
+        return self.model.input("input_ids").get_partial_shape()[0].is_dynamic
+
+    def slice_past(self, past_key_values, length: int):
+        """
+        Copies the first `length` positions of the KV-cache along the model
+        specific sequence axis
+        """
+        index = [slice(None)] * 4
+        index[self.adapter.kv_seq_axis] = slice(0, length)
+        return {
+            name: value[tuple(index)].copy()
+            for name, value in past_key_values.items()
+        }
+
+    def restore_past(self, input_ids, session: ChatSession = None):
+        """
+        Returns the longest KV-cache reusable for `input_ids`, taken from
+        `session` or from the prefix cache, together with the number of
+        prompt tokens it already covers. A `BlockTable` is returned as a
+        fork owned by the caller.
+        """
+        # at least one prompt token has to be fed to get the next logits
+        max_length = input_ids.shape[1] - 1
+        past_key_values, past_length = None, 0
+        if session is not None:
+            with session._lock:
+                if session.past_key_values is not None:
+                    past_key_values = session.past_key_values
+                    past_length = min(
+                        session.common_prefix_length(input_ids[0]), max_length)
+                    if isinstance(past_key_values, BlockTable):
+                        # the session may be evicted once the lock is gone
+                        past_key_values = past_key_values.fork(
+                            max(past_length, 0))
+        if self.prefix_cache is not None:
+            cached_past, cached_length = self.prefix_cache.lookup(
+                input_ids[0], max_length)
+            if cached_length > past_length:
+                if isinstance(past_key_values, BlockTable):
+                    past_key_values.release()
+                past_key_values, past_length = cached_past, cached_length
+            elif isinstance(cached_past, BlockTable):
+                cached_past.release()
+        if past_length <= 0:
+            if isinstance(past_key_values, BlockTable):
+                past_key_values.release()
+            return None, 0
+        if isinstance(past_key_values, BlockTable):
+            return past_key_values, past_length
+        cached_length = next(iter(
+            past_key_values.values())).shape[self.adapter.kv_seq_axis]
+        if past_length < cached_length:
+            past_key_values = self.slice_past(past_key_values, past_length)
+        return past_key_values, past_length
+
+    def reserve_blocks(self, length: int, past_key_values=None):
+        """
+        Returns a `BlockTable` with room for `length` positions, continuing
+        `past_key_values` if that is a `BlockTable` the caller owns. While
+        the pool is exhausted, prefix cache entries and then the KV-caches of
+        idle chat sessions are evicted, least recently used first.
+        `KVCacheExhausted` is raised if that is not enough.
+        """
+        if isinstance(past_key_values, BlockTable):
+            block_table = past_key_values
+        else:
+            block_table = BlockTable(self.kv_pool)
+        while True:
+            try:
+                block_table.reserve(length)
+                return block_table
+            except KVCacheExhausted:
+                if self.prefix_cache is not None and self.prefix_cache.evict_lru():
+                    continue
+                if not self.evict_session():
+                    block_table.release()
+                    raise
+
+    def keep_session(self, session: ChatSession):
+        """
+        Marks `session` as the most recently used one holding pool blocks
+        """
+        with self._lock:
+            self._sessions.pop(id(session), None)
+            self._sessions[id(session)] = weakref.ref(session)
+
+    def evict_session(self):
+        """
+        Resets the least recently used session still holding pool blocks,
+        its next turn prefills the whole prompt again. Returns False if there
+        is none. Sessions running a turn have handed their blocks over to
+        the generation and are not affected.
+        """
+        while True:
+            with self._lock:
+                if not self._sessions:
+                    return False
+                _, session_ref = self._sessions.popitem(last=False)
+            session = session_ref()
+            if session is not None and isinstance(session.past_key_values,
+                                                  BlockTable):
+                session.reset()
+                return True
+
+    def cache_prefix(self, prompt_tokens, past_key_values):
+        """
+        Stores the block aligned part of a just prefilled prompt in the
+        prefix cache, a `BlockTable` shares its blocks with the entry
+        """
+        length = self.prefix_cache.aligned_length(len(prompt_tokens))
+        if not length or self.prefix_cache.contains(prompt_tokens[:length]):
+            return
+        if isinstance(past_key_values, BlockTable):
+            entry = past_key_values.fork(length)
+        else:
+            entry = self.slice_past(past_key_values, length)
+        stored = self.prefix_cache.insert(prompt_tokens[:length], entry)
+        if not stored and isinstance(entry, BlockTable):
+            entry.release()
+
+    def prepare_inputs(self,
+                       input_ids,
+                       past_key_values,
+                       past_length: int,
+                       attention_mask=None):
+        batch_size, seq_len = input_ids.shape
+        inputs = {"input_ids": input_ids}
+        inputs.update(past_key_values)
+        if self.row_positions and attention_mask is not None:
+            # count the unmasked positions, padding on the left is skipped
+            position_ids = np.cumsum(attention_mask, axis=-1)[:, -seq_len:] - 1
+            inputs["position_ids"] = np.maximum(position_ids, 0)
+        elif self.adapter.use_position_ids or self.row_positions:
+            position_ids = np.arange(past_length,
+                                     past_length + seq_len,
+                                     dtype=np.int64)
+            inputs["position_ids"] = np.tile(position_ids, (batch_size, 1))
+        if self.adapter.use_attention_mask and attention_mask is not None:
+            inputs["attention_mask"] = attention_mask
+        elif self.adapter.use_attention_mask:
+            inputs["attention_mask"] = np.ones(
+                (batch_size, past_length + seq_len), dtype=np.int64)
+        return inputs
+
+    def forward(self,
+                input_ids,
+                past_key_values=None,
+                past_length: int = 0,
+                attention_mask=None,
+                kv_buffer: KVCacheBuffer = None,
+                request=None):
+        """
+        Runs one forward pass and returns the logits together with the
+        KV-cache to feed into the next step. With a `kv_buffer` the KV-cache
+        is read from and written into the buffer instead. The logits are
+        only valid until the next inference of `request`; without one, a
+        request is checked out of the pool for this call and the logits are
+        copied.
+        """
+        if request is None:
+            with self.requests.checkout() as request:
+                logits, past_key_values = self.forward(input_ids,
+                                                       past_key_values,
+                                                       past_length,
+                                                       attention_mask,
+                                                       kv_buffer, request)
+                return logits.copy(), past_key_values
+        profiler = self.profiler
+        batch_size, seq_len = input_ids.shape
+        with profiler.span("prepare_inputs"):
+            if kv_buffer is not None:
+                past_key_values = kv_buffer.past_key_values
+                kv_buffer.bind(request, past_length + seq_len)
+            else:
+                if past_key_values is None:
+                    past_key_values = self.empty_past(batch_size)
+                # the runtime writes into bound output tensors from then on,
+                # so every call has to provide them
+                for input_name, output_name in zip(
+                        self.key_value_input_names,
+                        self.key_value_output_names):
+                    request.set_tensor(
+                        output_name,
+                        Tensor(
+                            self.model.input(input_name).get_element_type(),
+                            self.kv_shape(input_name, batch_size,
+                                          past_length + seq_len)))
+            inputs = self.prepare_inputs(input_ids, past_key_values,
+                                         past_length, attention_mask)
+        start = time.perf_counter()
+        with profiler.span("infer"):
+            request.start_async(inputs, share_inputs=True)
+            request.wait()
+        timings = self.load_timings
+        if timings is not None and timings.first_inference is None:
+            timings.first_inference = time.perf_counter() - start
+        with profiler.span("readback"):
+            if self.topk_logits:
+                logits = TopKLogits(
+                    request.get_tensor("topk_logits").data,
+                    request.get_tensor("topk_indices").data)
+            else:
+                logits = request.get_tensor("logits").data
+            if kv_buffer is not None:
+                kv_buffer.advance(past_length + seq_len)
+                return logits, kv_buffer.arrays()
+            past_key_values = {
+                input_name: request.get_tensor(output_name).data
+                for input_name, output_name in zip(
+                    self.key_value_input_names, self.key_value_output_names)
+            }
+        return logits, past_key_values
+
+    def prefill(self,
+                input_ids,
+                past_length: int,
+                kv_buffer: KVCacheBuffer,
+                request):
+        """
+        Feeds the prompt into `kv_buffer` in chunks of at most
+        `prefill_chunk_size` tokens, which bounds the activation memory of
+        long prompts. Returns the outputs of the last chunk.
+        """
+        chunk_size = self.prefill_chunk_size or input_ids.shape[1]
+        for start in range(0, input_ids.shape[1], chunk_size):
+            with self.profiler.span("prefill"):
+                logits, past_key_values = self.forward(
+                    input_ids[:, start:start + chunk_size],
+                    past_length=past_length + start,
+                    kv_buffer=kv_buffer,
+                    request=request)
+        return logits, past_key_values
+
+    def generate(self,
+                 input_ids,
+                 max_generated_tokens,
+                 top_k=20,
+                 top_p=0.7,
+                 temperature=1,
+                 session: ChatSession = None):
+        """
+        Yields generated token ids one by one until a stop token is sampled
+        or `max_generated_tokens` tokens were produced. When a `session` is
+        given, the prompt prefix it already holds is not prefilled again and
+        the KV-cache is stored back into it once generation ends. With a
+        `kv_pool` the blocks for the whole generation are reserved up front,
+        `KVCacheExhausted` is raised if the pool cannot provide them.
+
+        With a `drafter` every decode step verifies its draft tokens in one
+        multi-token forward pass and rolls the KV-cache back behind the
+        first rejected one. That needs the full logits of every position,
+        so it is not available for models returning the last position or
+        the top k logits only.
+        """
+        if self.drafter is not None and not self.full_logits:
+            raise ValueError(
+                "speculative decoding needs a model exported without "
+                "--last_token_logits and --topk_head")
+        profiler = self.profiler
+        start = time.perf_counter_ns()
+        prompt_tokens = input_ids[0]
+        past_key_values, past_length = self.restore_past(input_ids, session)
+        input_ids = input_ids[:, past_length:]
+        output_tokens = []
+        cached_length = past_length
+        block_table, kv_buffer, request = None, None, None
+        started = False
+        drafter, draft_state = self.drafter, None
+        metrics, finish_reason = self.metrics, "error"
+        if metrics is not None:
+            metrics.begin(len(prompt_tokens), cached_length)
+            last_token_time = start
+        try:
+            # the KV buffers in use are bounded by the number of requests
+            request = self.requests.acquire()
+            if self.kv_pool is not None:
+                if session is not None:
+                    # evicting it would not free the blocks of the fork
+                    with self._lock:
+                        self._sessions.pop(id(session), None)
+                block_table = self.reserve_blocks(
+                    len(prompt_tokens) + max_generated_tokens,
+                    past_key_values)
+            kv_buffer = self.acquire_kv_buffer(
+                len(prompt_tokens) + max_generated_tokens)
+            kv_buffer.load(past_key_values, past_length)
+            if session is not None and block_table is not None:
+                # the new table shares what is still needed of the old one
+                session.reset()
+            started = True
+            if drafter is not None:
+                draft_state = drafter.begin(prompt_tokens,
+                                            max_generated_tokens)
+            stopped = False
+            while len(output_tokens) < max_generated_tokens:
+                draft_tokens, draft_probs = [], None
+                if drafter is not None and output_tokens:
+                    with profiler.span("draft"):
+                        draft_tokens, draft_probs = drafter.propose(
+                            draft_state,
+                            np.concatenate((prompt_tokens, output_tokens)),
+                            max_generated_tokens - len(output_tokens) - 1,
+                            top_k=top_k,
+                            top_p=top_p,
+                            temperature=temperature)
+                    input_ids = np.array([[output_tokens[-1]] + draft_tokens],
+                                         dtype=np.longlong)
+                    profiler.count("draft_tokens", len(draft_tokens))
+                if output_tokens:
+                    with profiler.span("decode"):
+                        logits, past_key_values = self.forward(
+                            input_ids,
+                            past_length=past_length,
+                            kv_buffer=kv_buffer,
+                            request=request)
+                else:
+                    logits, past_key_values = self.prefill(
+                        input_ids, past_length, kv_buffer, request)
+                past_length += input_ids.shape[1]
+                if self.prefix_cache is not None and not output_tokens:
+                    if block_table is not None:
+                        block_table.write(past_key_values, past_length)
+                        self.cache_prefix(prompt_tokens, block_table)
+                    else:
+                        self.cache_prefix(prompt_tokens, past_key_values)
+                if draft_tokens:
+                    with profiler.span("verify"):
+                        next_tokens = self.sampler.verify(
+                            logits[0, -len(draft_tokens) - 1:],
+                            draft_tokens,
+                            draft_probs,
+                            top_k=top_k,
+                            top_p=top_p,
+                            temperature=temperature)
+                    profiler.count("accepted_draft_tokens",
+                                   len(next_tokens) - 1)
+                    # drop the KV-cache of the rejected draft tokens
+                    past_length -= len(draft_tokens) + 1 - len(next_tokens)
+                    kv_buffer.truncate(past_length)
+                else:
+                    with profiler.span("sample"):
+                        next_tokens = self.sampler.sample(
+                            logits[:, -1],
+                            top_k=top_k,
+                            top_p=top_p,
+                            temperature=temperature)[:1].tolist()
+                stopped = False
+                for next_token in next_tokens:
+                    stopped = self.adapter.is_stop_token(next_token)
+                    if stopped:
+                        break
+                    output_tokens.append(next_token)
+                    if metrics is not None:
+                        now = time.perf_counter_ns()
+                        metrics.token((now - last_token_time) * 1e-9,
+                                      len(output_tokens) == 1)
+                        last_token_time = now
+                    yield next_token
+                if stopped:
+                    break
+                input_ids = np.array([[next_tokens[-1]]], dtype=np.longlong)
+            finish_reason = "stop" if stopped else "length"
+        except GeneratorExit:
+            finish_reason = "cancelled"
+            raise
+        finally:
+            if request is not None:
+                self.requests.release(request)
+            if draft_state is not None:
+                drafter.end(draft_state)
+            if not started:
+                # failed before the first step, the session keeps its
+                # KV-cache
+                if block_table is not None:
+                    block_table.release()
+                if kv_buffer is not None:
+                    self.release_kv_buffer(kv_buffer)
+                if session is not None and isinstance(
+                        session.past_key_values, BlockTable):
+                    self.keep_session(session)
+            else:
+                # accepted draft tokens after a stop token are not part of
+                # the answer
+                past_length = min(past_length,
+                                  len(prompt_tokens) + len(output_tokens))
+                self.store_past(
+                    session, block_table, kv_buffer, past_length,
+                    np.concatenate((prompt_tokens, output_tokens)))
+            if metrics is not None:
+                metrics.end(finish_reason,
+                            (time.perf_counter_ns() - start) * 1e-9)
+            if profiler.enabled:
+                profiler.record(
+                    "generate", start, time.perf_counter_ns(), {
+                        "prompt_tokens": len(prompt_tokens),
+                        "cached_tokens": cached_length,
+                        "generated_tokens": len(output_tokens),
+                    })
+                profiler.count("generated_tokens", len(output_tokens))
+
+    def store_past(self, session: ChatSession, block_table: BlockTable,
+                   kv_buffer: KVCacheBuffer, past_length: int, tokens):
+        """
+        Hands the first `past_length` positions of a finished generation over
+        to `session`, or frees its blocks without one, and returns
+        `kv_buffer` for reuse
+        """
+        if block_table is not None:
+            block_table.write(kv_buffer.arrays(), past_length)
+            block_table.truncate(past_length)
+        if session is not None and past_length:
+            if block_table is not None:
+                session.past_key_values = block_table
+                self.keep_session(session)
+            else:
+                # the buffer is handed to the next generation, so the
+                # session keeps its own copy
+                session.past_key_values = self.slice_past(
+                    kv_buffer.arrays(), past_length)
+            session.tokens = np.asarray(tokens,
+                                        dtype=np.int64)[:past_length]
+        elif block_table is not None:
+            block_table.release()
+        self.release_kv_buffer(kv_buffer)
+
+    def generate_sequence(self,
+                          input_ids,
+                          max_generated_tokens=100,
+                          top_k=20,
+                          top_p=0.7,
+                          temperature=1,
+                          session: ChatSession = None):
+        output_tokens = list(
+            self.generate(input_ids,
+                          max_generated_tokens,
+                          top_k=top_k,
+                          top_p=top_p,
+                          temperature=temperature,
+                          session=session))
+        # one forward pass per token plus the one that sampled the stop token
+        num_iteration = len(output_tokens)
+        if num_iteration < max_generated_tokens:
+            num_iteration += 1
+        return output_tokens, num_iteration
+
+    def generate_stream(self,
+                        input_ids,
+                        max_generated_tokens,
+                        top_k=20,
+                        top_p=0.7,
+                        temperature=1,
+                        session: ChatSession = None):
+        """
+        Yields the post-processed answer in increments as tokens arrive
+        """
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        processor = IncrementalResponseProcessor(self.adapter.stop_text)
+        tokens = self.generate(input_ids,
+                               max_generated_tokens,
+                               top_k=top_k,
+                               top_p=top_p,
+                               temperature=temperature,
+                               session=session)
+        try:
+            for next_token in tokens:
+                with self.profiler.span("detokenize"):
+                    text = processor.feed(detokenizer.add(next_token))
+                if text:
+                    yield text
+                if processor.stopped:
+                    return
+            text = processor.flush()
+            if text:
+                yield text
+        finally:
+            tokens.close()
+
+    def generate_iterate(self,
+                         input_ids,
+                         max_generated_tokens,
+                         top_k=20,
+                         top_p=0.7,
+                         temperature=1,
+                         session: ChatSession = None):
+        """
+        Yields the whole answer generated so far every time it grows
+        """
+        response = ""
+        for text in self.generate_stream(input_ids,
+                                         max_generated_tokens,
+                                         top_k=top_k,
+                                         top_p=top_p,
+                                         temperature=temperature,
+                                         session=session):
+            response += text
+            yield response
@@ -2,9 +2,12 @@ from chatglm2.modeling import ChatGLMModel
 from qwen.modeling import QwenModel
 from baichuan2.modeling import BaichuanModel
 from internlm.modeling import InternLMModel
+from speculative import DraftModelDrafter, PromptLookupDrafter
+from synthetic import load_tokenizer
+from runtime import (RuntimeConfig, add_runtime_args, format_memory,
+                     memory_usage)
 import argparse
 import time
-from utils import process_response
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(add_help=False)
@@ -35,28 +38,108 @@ if __name__ == "__main__":
                         required=False,
                         type=str,
                         help='Required. device for inference')
+    parser.add_argument('-s',
+                        '--seed',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. random seed for reproducible sampling')
+    parser.add_argument('-dm',
+                        '--draft_model',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. path to the IR (.xml) of a smaller draft model sharing the tokenizer for speculative decoding')
+    parser.add_argument('-pl',
+                        '--prompt_lookup',
+                        action='store_true',
+                        help='Optional. speculative decoding with drafts looked up in the prompt')
+    parser.add_argument('-k',
+                        '--num_draft_tokens',
+                        default=4,
+                        required=False,
+                        type=int,
+                        help='Optional. number of tokens drafted per speculative decoding step')
+    parser.add_argument('-c',
+                        '--cache_dir',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. directory caching the compiled model to cut start-up time')
+    parser.add_argument('-pf',
+                        '--prefill_chunk_size',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. longest prompt part prefilled in one inference, caps the memory of long prompts')
+    parser.add_argument('--no_mmap',
+                        action='store_true',
+                        help='Optional. read the weights into process memory instead of memory mapping them')
+    parser.add_argument('--profile',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. time every generation step and write a Chrome trace to this JSON file')
+    add_runtime_args(parser)
     args = parser.parse_args()
+    config = RuntimeConfig.from_args(args)
 
     model_id = args.model_path
+    tokenizer = load_tokenizer(model_id)
     if 'chatglm2' in model_id:
-        ov_model = ChatGLMModel(model_id, args.device)
+        ov_model = ChatGLMModel(model_id, args.device,
+                                cache_dir=args.cache_dir,
+                                mmap=not args.no_mmap,
+                                config=config,
+                                tokenizer=tokenizer)
     elif 'qwen' in model_id:
-        ov_model = QwenModel(model_id, args.device)
+        ov_model = QwenModel(model_id, args.device,
+                             cache_dir=args.cache_dir,
+                             mmap=not args.no_mmap,
+                             config=config,
+                             tokenizer=tokenizer)
     elif 'baichuan2' in model_id:
-        ov_model = BaichuanModel(model_id, args.device)
+        ov_model = BaichuanModel(model_id, args.device,
+                                 cache_dir=args.cache_dir,
+                                 mmap=not args.no_mmap,
+                                 config=config,
+                                 tokenizer=tokenizer)
     elif 'internlm' in model_id:
-        ov_model = InternLMModel(model_id, args.device)
+        ov_model = InternLMModel(model_id, args.device,
+                                 cache_dir=args.cache_dir,
+                                 mmap=not args.no_mmap,
+                                 config=config,
+                                 tokenizer=tokenizer)
     else:
         raise NotImplementedError(f"Unsupported model id {model_id!r}")
+    ov_model.engine.sampler.seed(args.seed)
+    ov_model.engine.profiler.enabled = args.profile is not None
+    ov_model.engine.prefill_chunk_size = args.prefill_chunk_size
+    if (args.draft_model or args.prompt_lookup) and not ov_model.engine.full_logits:
+        parser.error("speculative decoding needs a model exported without "
+                     "--last_token_logits and --topk_head")
+    if args.draft_model:
+        ov_model.engine.drafter = DraftModelDrafter.from_ir(
+            ov_model.core, args.draft_model, ov_model.engine, args.device,
+            args.num_draft_tokens, config)
+    elif args.prompt_lookup:
+        ov_model.engine.drafter = PromptLookupDrafter(args.num_draft_tokens)
     
-    input_data = ov_model.build_inputs([], args.prompt)
+    input_data = ov_model.build_inputs(
+        [], args.prompt, max_generated_tokens=args.max_sequence_length)
     print(" --- start generating --- ")
     start = time.perf_counter()
-    response, num_tokens = ov_model.generate_sequence(
+    response, _ = ov_model.generate_sequence(
         input_data, max_generated_tokens=args.max_sequence_length)
     end = time.perf_counter()
-    answer = process_response(
+    answer = ov_model.engine.adapter.postprocess(
         ov_model.tokenizer.decode(response, skip_special_tokens=True))
-    answer = answer.split("<eoa>")[0]
     print(answer)
-    print(f"Generated {num_tokens} tokens in {end - start:.3f} s")
\ No newline at end of file
+    print(f"Generated {len(response)} tokens in {end - start:.3f} s, "
+          f"{len(response) / (end - start):.2f} tokens/s")
+    print("Use benchmark.py for prefill and decode latency")
+    print(f"Model loading: {ov_model.load_timings.report()}")
+    print(f"Memory: {format_memory(memory_usage())}")
+    if args.profile:
+        ov_model.engine.profiler.export_chrome_trace(args.profile)
+        print(ov_model.engine.profiler.report())
\ No newline at end of file
@@ -0,0 +1,483 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from openvino.runtime import Tensor
+
+
+class PrefixCache():
+    """
+    LRU cache of KV-cache tensors for token prefixes shared between requests,
+    e.g. the system prompt or the ChatML header every conversation starts with.
+
+    Prompts are split into blocks of `block_size` tokens and every block
+    boundary is keyed by a chained hash of the token ids before it, so a
+    lookup finds the longest cached prefix of a new prompt even if it was
+    stored as part of a longer, different prompt.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30, block_size: int = 16) -> None:
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # entry key -> (tokens, past_key_values, nbytes, block hashes)
+        self._entries = OrderedDict()
+        # block hash -> keys of the entries containing that block prefix
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def aligned_length(self, length: int):
+        return length - length % self.block_size
+
+    def _block_hashes(self, tokens):
+        hashes = []
+        value = 0
+        for start in range(0, self.aligned_length(len(tokens)),
+                           self.block_size):
+            block = tokens[start:start + self.block_size]
+            value = hash((value, block.astype(np.int64).tobytes()))
+            hashes.append(value)
+        return hashes
+
+    def contains(self, tokens):
+        hashes = self._block_hashes(tokens)
+        if not hashes or len(tokens) % self.block_size:
+            return False
+        with self._lock:
+            for key in self._index.get(hashes[-1], ()):
+                if np.array_equal(self._entries[key][0][:len(tokens)],
+                                  tokens):
+                    return True
+        return False
+
+    def lookup(self, tokens, max_length: int = None):
+        """
+        Returns the KV-cache of the longest cached prefix of `tokens` not
+        longer than `max_length` and the number of tokens it covers. The
+        returned tensors may be longer than the match and must not be
+        modified, a `BlockTable` is returned as a fork owned by the caller.
+        """
+        if max_length is None:
+            max_length = len(tokens)
+        hashes = self._block_hashes(tokens[:max_length])
+        with self._lock:
+            for num_blocks in range(len(hashes), 0, -1):
+                for key in self._index.get(hashes[num_blocks - 1], ()):
+                    cached_tokens, past_key_values = self._entries[key][:2]
+                    length = num_blocks * self.block_size
+                    if np.array_equal(cached_tokens[:length],
+                                      tokens[:length]):
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        if isinstance(past_key_values, BlockTable):
+                            past_key_values = past_key_values.fork(length)
+                        return past_key_values, length
+            self.misses += 1
+        return None, 0
+
+    def insert(self, tokens, past_key_values):
+        """
+        Stores `past_key_values`, a dict of tensors or a `BlockTable`,
+        covering exactly `tokens`. Callers should pass block aligned
+        prefixes, see `aligned_length`. Returns whether the entry was stored,
+        the cache takes ownership of a stored `BlockTable`.
+        """
+        hashes = self._block_hashes(tokens)
+        if not hashes or len(tokens) % self.block_size:
+            return False
+        if isinstance(past_key_values, BlockTable):
+            nbytes = past_key_values.nbytes
+        else:
+            nbytes = sum(value.nbytes for value in past_key_values.values())
+        if nbytes > self.max_bytes:
+            return False
+        key = hashes[-1]
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return False
+            while self.used_bytes + nbytes > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+            self._entries[key] = (np.array(tokens), past_key_values, nbytes,
+                                  hashes)
+            self.used_bytes += nbytes
+            for block_hash in hashes:
+                self._index.setdefault(block_hash, {})[key] = None
+        return True
+
+    def _evict(self, key):
+        _, past_key_values, nbytes, hashes = self._entries.pop(key)
+        if isinstance(past_key_values, BlockTable):
+            past_key_values.release()
+        self.used_bytes -= nbytes
+        for block_hash in hashes:
+            keys = self._index[block_hash]
+            keys.pop(key, None)
+            if not keys:
+                del self._index[block_hash]
+
+    def evict_lru(self):
+        """
+        Drops the least recently used entry, returns False if the cache is
+        empty
+        """
+        with self._lock:
+            if not self._entries:
+                return False
+            self._evict(next(iter(self._entries)))
+        return True
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._evict(next(iter(self._entries)))
+            self.used_bytes = 0
+
+
+class KVCacheExhausted(RuntimeError):
+    """
+    Raised when the `KVBlockPool` has no free blocks left for a sequence
+    """
+
+
+class KVBlockPool():
+    """
+    Fixed memory budget for the KV-caches of all sequences of one model,
+    carved into blocks of `block_size` token positions. Sequences address
+    their KV-cache through a `BlockTable` instead of owning separately
+    allocated arrays, so memory does not fragment and usage is bounded by
+    `max_bytes`. Blocks are reference counted: forked tables share their
+    common prefix and a shared block is copied before it is written.
+
+    The storage is allocated once the pool is attached to a
+    `GenerationEngine`, which knows the KV-cache shapes.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30, block_size: int = 16) -> None:
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.num_blocks = 0
+        self.block_nbytes = 0
+        self.engine = None
+        self._storage = None
+        self._ref_counts = None
+        self._free = []
+        # reentrant, a session garbage collected while the lock is held
+        # releases its blocks from the same thread
+        self._lock = threading.RLock()
+
+    def attach(self, engine):
+        if self.engine is engine:
+            return
+        if self.engine is not None:
+            raise ValueError("A KVBlockPool can only serve one model")
+        block_shapes = {
+            name: engine.kv_shape(name, 1, self.block_size)
+            for name in engine.key_value_input_names
+        }
+        dtypes = {
+            name: engine.model.input(name).get_element_type().to_dtype()
+            for name in engine.key_value_input_names
+        }
+        self.block_nbytes = sum(
+            int(np.prod(shape)) * dtypes[name].itemsize
+            for name, shape in block_shapes.items())
+        self.num_blocks = self.max_bytes // self.block_nbytes
+        # pages are only committed by the OS once a block is first written
+        self._storage = {
+            name: np.zeros([self.num_blocks] + shape, dtype=dtypes[name])
+            for name, shape in block_shapes.items()
+        }
+        self._ref_counts = np.zeros(self.num_blocks, dtype=np.int32)
+        self._free = list(range(self.num_blocks - 1, -1, -1))
+        self.engine = engine
+
+    @property
+    def num_free_blocks(self):
+        return len(self._free)
+
+    @property
+    def num_used_blocks(self):
+        return self.num_blocks - len(self._free)
+
+    def blocks_needed(self, length: int):
+        return -(-length // self.block_size)
+
+    def can_allocate(self, num_blocks: int):
+        return num_blocks <= len(self._free)
+
+    def usage(self):
+        return {
+            "block_size": self.block_size,
+            "total_blocks": self.num_blocks,
+            "used_blocks": self.num_used_blocks,
+            "free_blocks": self.num_free_blocks,
+            "used_bytes": self.num_used_blocks * self.block_nbytes,
+            "max_bytes": self.num_blocks * self.block_nbytes,
+        }
+
+    def _allocate(self, num_blocks: int):
+        with self._lock:
+            if num_blocks > len(self._free):
+                raise KVCacheExhausted(
+                    f"{num_blocks} KV-cache blocks requested, "
+                    f"{len(self._free)} of {self.num_blocks} free")
+            blocks = [self._free.pop() for _ in range(num_blocks)]
+            self._ref_counts[blocks] = 1
+        return blocks
+
+    def _share(self, blocks):
+        with self._lock:
+            for block in blocks:
+                self._ref_counts[block] += 1
+
+    def _release(self, blocks):
+        with self._lock:
+            for block in blocks:
+                self._ref_counts[block] -= 1
+                if self._ref_counts[block] == 0:
+                    self._free.append(block)
+
+    def _is_shared(self, block: int):
+        return self._ref_counts[block] > 1
+
+    def _copy_block(self, source: int, target: int):
+        for storage in self._storage.values():
+            storage[target] = storage[source]
+
+    def _seq_index(self, start: int, stop: int):
+        index = [slice(None)] * 4
+        index[self.engine.adapter.kv_seq_axis] = slice(start, stop)
+        return tuple(index)
+
+    def _block_index(self, block: int, start: int, stop: int):
+        return (block, ) + self._seq_index(start, stop)
+
+
+class BlockTable():
+    """
+    KV-cache of one sequence stored in a `KVBlockPool`: the ids of its blocks
+    in position order and the number of positions written to them.
+    """
+
+    def __init__(self, pool: KVBlockPool) -> None:
+        self.pool = pool
+        self.blocks = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nbytes(self):
+        return len(self.blocks) * self.pool.block_nbytes
+
+    def reserve(self, length: int):
+        """
+        Makes sure `length` positions can be written without allocating:
+        takes the missing blocks from the pool and copies the shared block
+        the next write would modify. Raises `KVCacheExhausted` when the pool
+        has no blocks left, the table is unchanged then.
+        """
+        block_size = self.pool.block_size
+        tail = self.length // block_size
+        copy_tail = (length > self.length and self.length % block_size != 0
+                     and self.pool._is_shared(self.blocks[tail]))
+        num_blocks = max(0, self.pool.blocks_needed(length) - len(self.blocks))
+        blocks = self.pool._allocate(num_blocks + int(copy_tail))
+        if copy_tail:
+            new_block = blocks.pop()
+            self.pool._copy_block(self.blocks[tail], new_block)
+            self.pool._release([self.blocks[tail]])
+            self.blocks[tail] = new_block
+        self.blocks.extend(blocks)
+
+    def write(self, past_key_values, length: int):
+        """
+        Appends positions `self.length` to `length` of the contiguous,
+        single sequence `past_key_values` to the table
+        """
+        self.reserve(length)
+        block_size = self.pool.block_size
+        start = self.length
+        while start < length:
+            block = start // block_size
+            stop = min(length, (block + 1) * block_size)
+            offset = block * block_size
+            for name, storage in self.pool._storage.items():
+                storage[self.pool._block_index(
+                    self.blocks[block], start - offset,
+                    stop - offset)] = past_key_values[name][
+                        self.pool._seq_index(start, stop)]
+            start = stop
+        self.length = max(self.length, length)
+
+    def read_into(self, past_key_values, length: int):
+        """
+        Copies the first `length` positions into the contiguous arrays
+        `past_key_values`
+        """
+        block_size = self.pool.block_size
+        for block in range(self.pool.blocks_needed(length)):
+            start = block * block_size
+            stop = min(length, start + block_size)
+            for name, storage in self.pool._storage.items():
+                past_key_values[name][self.pool._seq_index(
+                    start, stop)] = storage[self.pool._block_index(
+                        self.blocks[block], 0, stop - start)]
+
+    def fork(self, length: int = None):
+        """
+        Returns a table sharing the blocks of the first `length` positions
+        """
+        if length is None:
+            length = self.length
+        table = BlockTable(self.pool)
+        table.blocks = self.blocks[:self.pool.blocks_needed(length)]
+        table.length = min(length, self.length)
+        self.pool._share(table.blocks)
+        return table
+
+    def truncate(self, length: int):
+        """
+        Returns the blocks behind the first `length` positions to the pool
+        """
+        num_blocks = self.pool.blocks_needed(length)
+        self.pool._release(self.blocks[num_blocks:])
+        del self.blocks[num_blocks:]
+        self.length = min(self.length, length)
+
+    def release(self):
+        self.pool._release(self.blocks)
+        self.blocks = []
+        self.length = 0
+
+
+class KVCacheBuffer():
+    """
+    Preallocated, double buffered KV-cache of one generation or of the rows
+    of a `BatchScheduler` batch. The runtime writes the `present.*` outputs
+    of a step straight into the spare buffer, which then becomes the
+    `past_key_values.*` input of the next step, so no memory is allocated
+    per token. Both buffers hold `capacity` positions along the model
+    specific sequence axis and only grow, by doubling, when a generation
+    outlives them, or when more rows than ever before are loaded.
+    """
+
+    def __init__(self, engine, batch_size: int = 1, capacity: int = 256) -> None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.capacity = 0
+        self.length = 0
+        # rows the buffers are allocated for, at least `batch_size`
+        self._rows = batch_size
+        self._front = None
+        self._back = None
+        self.reserve(capacity)
+
+    def _allocate(self, capacity: int):
+        return {
+            name: Tensor(self.engine.model.input(name).get_element_type(),
+                         self.engine.kv_shape(name, self._rows, capacity))
+            for name in self.engine.key_value_input_names
+        }
+
+    def _resize(self, slot, length: int):
+        for name, tensor in slot.items():
+            tensor.shape = self.engine.kv_shape(name, self.batch_size, length)
+
+    def reserve(self, length: int):
+        """
+        Makes sure both buffers can hold `length` positions
+        """
+        if length <= self.capacity:
+            return
+        capacity = max(length, 2 * self.capacity)
+        front = self._allocate(capacity)
+        if self.length:
+            self._resize(front, self.length)
+            for name, tensor in front.items():
+                tensor.data[...] = self._front[name].data
+        self._front = front
+        self._back = self._allocate(capacity)
+        self.capacity = capacity
+        self._resize(self._front, self.length)
+
+    @property
+    def num_positions(self):
+        """
+        Positions of all rows either buffer is allocated for
+        """
+        return self._rows * self.capacity
+
+    @property
+    def past_key_values(self):
+        return self._front
+
+    def arrays(self):
+        return {name: tensor.data for name, tensor in self._front.items()}
+
+    def load(self, past_key_values, length: int, batch_size: int = None):
+        """
+        Copies an existing KV-cache, e.g. from a chat session, into the
+        buffer. `batch_size` changes the number of rows, e.g. after sequences
+        joined or left a batch.
+        """
+        if batch_size is not None and batch_size != self.batch_size:
+            self.batch_size = batch_size
+            self.length = 0
+            if batch_size > self._rows:
+                self._rows = batch_size
+                self.capacity = 0
+        self.reserve(length)
+        self.length = length
+        self._resize(self._front, length)
+        if not length:
+            return
+        if isinstance(past_key_values, BlockTable):
+            past_key_values.read_into(self.arrays(), length)
+            return
+        for name, tensor in self._front.items():
+            tensor.data[...] = past_key_values[name]
+
+    def truncate(self, length: int):
+        """
+        Drops the positions from `length` on, e.g. rejected draft tokens
+        """
+        if length >= self.length:
+            return
+        seq_axis = self.engine.adapter.kv_seq_axis
+        for name, tensor in self._front.items():
+            if int(np.prod(list(tensor.shape)[:seq_axis])) == 1:
+                # the kept positions are a prefix of the memory
+                self._resize({name: tensor}, length)
+                continue
+            index = [slice(None)] * 4
+            index[seq_axis] = slice(0, length)
+            self._resize({name: self._back[name]}, length)
+            self._back[name].data[...] = tensor.data[tuple(index)]
+            self._front[name], self._back[name] = self._back[name], tensor
+        self.length = length
+
+    def bind(self, request, length: int):
+        """
+        Lets the next inference of `request` write its `present.*` outputs
+        of `length` positions into the spare buffer
+        """
+        self.reserve(length)
+        self._resize(self._back, length)
+        for input_name, output_name in zip(self.engine.key_value_input_names,
+                                           self.engine.key_value_output_names):
+            request.set_tensor(output_name, self._back[input_name])
+
+    def advance(self, length: int):
+        """
+        Swaps the buffers once the bound inference finished
+        """
+        self._front, self._back = self._back, self._front
+        self.length = length
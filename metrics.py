@@ -0,0 +1,440 @@
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from runtime import memory_usage
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15,
+                         0.2, 0.3, 0.5, 1.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+            '"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric():
+    """
+    One metric family. `labels` returns the child of a label combination,
+    the methods of an unlabelled metric act on its only child.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects the labels {self.labelnames}")
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+        return child
+
+    def _unlabelled(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} needs the labels {self.labelnames}")
+        return self.labels()
+
+    def samples(self):
+        """
+        Yields (name suffix, labels, value) of every child
+        """
+        if not self.labelnames:
+            # unlabelled metrics are exposed from the start
+            self._unlabelled()
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            labels = list(zip(self.labelnames, key))
+            for suffix, extra_labels, value in child.samples():
+                yield suffix, labels + extra_labels, value
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} "
+                         f"{_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _CounterChild():
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1):
+        if value < 0:
+            raise ValueError("counters can only increase")
+        with self._lock:
+            self.value += value
+
+    def set_function(self, function):
+        """
+        Reads the total from `function` at exposition time instead, for
+        counts another object already keeps, it must never decrease
+        """
+        self.function = function
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [("_total", [], value)]
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count, exposed with the `_total` suffix
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        if name.endswith("_total"):
+            name = name[:-len("_total")]
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, value: float = 1):
+        self._unlabelled().inc(value)
+
+    def set_function(self, function):
+        self._unlabelled().set_function(function)
+
+
+class _GaugeChild():
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, value: float = 1):
+        with self._lock:
+            self.value += value
+
+    def dec(self, value: float = 1):
+        self.inc(-value)
+
+    def set_function(self, function):
+        """
+        Reads the value from `function` at exposition time instead
+        """
+        self.function = function
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [("", [], value)]
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, e.g. a queue depth or the bytes in use
+    """
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._unlabelled().set(value)
+
+    def inc(self, value: float = 1):
+        self._unlabelled().inc(value)
+
+    def dec(self, value: float = 1):
+        self._unlabelled().dec(value)
+
+    def set_function(self, function):
+        self._unlabelled().set_function(function)
+
+
+class _HistogramChild():
+
+    def __init__(self, buckets) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[idx] += 1
+                    break
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(("_bucket", [("le", _format_value(bound))],
+                            cumulative))
+        samples.append(("_sum", [], total))
+        samples.append(("_count", [], count))
+        return samples
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative `le` buckets, the +Inf
+    bucket is always added
+    """
+
+    type = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames=(),
+                 buckets=LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        buckets = sorted(float(bound) for bound in buckets)
+        if not buckets or buckets[-1] != math.inf:
+            buckets.append(math.inf)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._unlabelled().observe(value)
+
+
+class MetricsRegistry():
+    """
+    The metrics of one process, rendered in the Prometheus text exposition
+    format by `expose`. Asking for an existing name returns that metric.
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(
+                    name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(
+                    f"{name} is already registered as a {metric.type}")
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  labelnames=(),
+                  buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames,
+                                   buckets)
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+class GenerationMetrics():
+    """
+    Metrics of the generation loop, updated by `GenerationEngine.generate`
+    and the `BatchScheduler` of an engine once `attach`ed. The KV-cache,
+    infer request and scheduler gauges are read at exposition time.
+    """
+
+    def __init__(self, registry: MetricsRegistry) -> None:
+        self.registry = registry
+        self.generations = registry.counter(
+            "ov_generations_total", "Finished generations",
+            ("finish_reason", ))
+        self.prompt_tokens = registry.counter("ov_prompt_tokens_total",
+                                              "Prompt tokens submitted")
+        self.cached_prompt_tokens = registry.counter(
+            "ov_cached_prompt_tokens_total",
+            "Prompt tokens restored from a session or the prefix cache")
+        self.generated_tokens = registry.counter("ov_generated_tokens_total",
+                                                 "Tokens generated")
+        self.active_generations = registry.gauge(
+            "ov_active_generations", "Generations currently running")
+        self.time_to_first_token = registry.histogram(
+            "ov_time_to_first_token_seconds",
+            "Time from submitting a prompt to its first generated token")
+        self.inter_token_latency = registry.histogram(
+            "ov_inter_token_latency_seconds",
+            "Time between consecutive generated tokens of one sequence",
+            buckets=TOKEN_LATENCY_BUCKETS)
+        self.generation_duration = registry.histogram(
+            "ov_generation_duration_seconds",
+            "Time from submitting a prompt to its last generated token")
+
+    def attach(self, engine):
+        engine.metrics = self
+        registry = self.registry
+        requests = engine.requests
+        registry.gauge("ov_infer_requests",
+                       "Infer requests of the compiled model").set(len(requests))
+        registry.gauge("ov_infer_requests_free",
+                       "Infer requests not checked out").set_function(
+                           lambda: requests.num_free)
+        kv_pool = engine.kv_pool
+        if kv_pool is not None:
+            registry.gauge("ov_kv_pool_capacity_bytes",
+                           "Bytes of the paged KV-cache pool").set(
+                               kv_pool.num_blocks * kv_pool.block_nbytes)
+            registry.gauge("ov_kv_pool_used_bytes",
+                           "Bytes of KV-cache blocks in use").set_function(
+                               lambda: kv_pool.num_used_blocks *
+                               kv_pool.block_nbytes)
+        prefix_cache = engine.prefix_cache
+        if prefix_cache is not None:
+            registry.gauge("ov_prefix_cache_bytes",
+                           "Bytes held by the prefix cache").set_function(
+                               lambda: prefix_cache.used_bytes)
+            registry.counter("ov_prefix_cache_hits_total",
+                             "Prefix cache lookups that found an entry"
+                             ).set_function(lambda: prefix_cache.hits)
+            registry.counter("ov_prefix_cache_misses_total",
+                             "Prefix cache lookups that found nothing"
+                             ).set_function(lambda: prefix_cache.misses)
+        return self
+
+    def attach_scheduler(self, scheduler):
+        self.registry.gauge(
+            "ov_scheduler_queue_depth",
+            "Sequences waiting to be admitted").set_function(
+                lambda: len(scheduler.waiting))
+        self.registry.gauge(
+            "ov_scheduler_batch_size",
+            "Sequences decoded together in the current step").set_function(
+                lambda: len(scheduler.running))
+        return self
+
+    def begin(self, prompt_length: int, cached_length: int = 0):
+        self.prompt_tokens.inc(prompt_length)
+        self.cached_prompt_tokens.inc(cached_length)
+        self.active_generations.inc()
+
+    def token(self, seconds: float, first: bool):
+        """
+        Records a generated token `seconds` after the previous one, or after
+        submission for the `first`
+        """
+        if first:
+            self.time_to_first_token.observe(seconds)
+        else:
+            self.inter_token_latency.observe(seconds)
+        self.generated_tokens.inc()
+
+    def end(self, finish_reason: str, seconds: float = None):
+        """
+        Records a finished generation, `seconds` is None for one that never
+        started
+        """
+        self.generations.labels(finish_reason=finish_reason).inc()
+        if seconds is not None:
+            self.active_generations.dec()
+            self.generation_duration.observe(seconds)
+
+
+def add_process_metrics(registry: MetricsRegistry):
+    """
+    Resident memory gauges of this process, see `runtime.memory_usage`
+    """
+    fields = {
+        "rss": "Resident memory",
+        "peak_rss": "Peak resident memory",
+        "shared": "Resident memory shared with other processes",
+        "private": "Resident memory only this process maps",
+    }
+    for field, documentation in fields.items():
+        registry.gauge(f"ov_process_{field}_bytes", documentation).set_function(
+            lambda field=field: memory_usage()[field] or 0)
+    return registry
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(registry: MetricsRegistry,
+                  port: int,
+                  host: str = "127.0.0.1"):
+    """
+    Serves `/metrics` of `registry` from a daemon thread, for processes that
+    have no HTTP server of their own
+    """
+    handler = type("MetricsHandler", (_MetricsHandler, ),
+                   {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f" --- metrics on http://{host}:{port}/metrics --- ")
+    return server
@@ -0,0 +1,192 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# log-spaced histogram buckets, this many per doubling of the duration
+BUCKETS_PER_OCTAVE = 4
+
+_DISABLED_SPAN = nullcontext()
+
+
+class Histogram():
+    """
+    Durations in nanoseconds counted into log-spaced buckets, so memory stays
+    bounded however long the process runs. Percentiles are accurate to one
+    bucket, i.e. about 19%.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}
+
+    def add(self, duration: int):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        bucket = int(math.log2(max(duration, 1)) * BUCKETS_PER_OCTAVE)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float):
+        """
+        Upper bound of the bucket holding the `q` percentile
+        """
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2**((bucket + 1) / BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+    def summary(self):
+        to_ms = 1e-6
+        return {
+            "count": self.count,
+            "total_ms": self.total * to_ms,
+            "mean_ms": self.total / max(self.count, 1) * to_ms,
+            "p50_ms": self.percentile(50) * to_ms,
+            "p90_ms": self.percentile(90) * to_ms,
+            "p99_ms": self.percentile(99) * to_ms,
+            "max_ms": self.max * to_ms,
+        }
+
+
+class _Span():
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name: str, args) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter_ns(),
+                             self.args)
+        return False
+
+
+class Profiler():
+    """
+    Opt-in timing of the phases of the generation loop. Every `span` is
+    recorded with monotonic timestamps as a Chrome trace event of the thread
+    running it, which is one lane per concurrent generation, and added to the
+    duration histogram of its name; `count` accumulates counters.
+
+    A disabled profiler hands out one shared no-op context manager and
+    records nothing, so instrumented code pays a method call per span.
+    """
+
+    def __init__(self, enabled: bool = False, max_events: int = 1000000) -> None:
+        self.enabled = enabled
+        self.max_events = max_events
+        self.events = []
+        self.dropped_events = 0
+        self.histograms = {}
+        self.counters = {}
+        self._origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def span(self, name: str, args=None):
+        """
+        Context manager timing its block, `args` is a dict shown with the
+        event in the trace viewer
+        """
+        if not self.enabled:
+            return _DISABLED_SPAN
+        return _Span(self, name, args)
+
+    def record(self, name: str, start: int, end: int, args=None):
+        """
+        Records a span between two `time.perf_counter_ns` timestamps
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(end - start)
+            if len(self.events) >= self.max_events:
+                self.dropped_events += 1
+                return
+            self.events.append((name, start, end, threading.get_ident(),
+                                args))
+
+    def count(self, name: str, value: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+            self.dropped_events = 0
+            self.histograms = {}
+            self.counters = {}
+            self._origin = time.perf_counter_ns()
+
+    def chrome_trace(self):
+        """
+        The recorded spans in the Chrome trace event format, loadable in
+        chrome://tracing and https://ui.perfetto.dev
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+        trace_events = []
+        for name, start, end, thread_id, args in events:
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self._origin) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": pid,
+                "tid": thread_id,
+            }
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path):
+        with open(path, "w") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+    def summary(self):
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        return {
+            "spans": {
+                name: histogram.summary()
+                for name, histogram in sorted(histograms.items())
+            },
+            "counters": counters,
+            "dropped_events": self.dropped_events,
+        }
+
+    def report(self):
+        summary = self.summary()
+        lines = [
+            f"{'span':<16}{'count':>8}{'total ms':>12}{'mean ms':>10}"
+            f"{'p50 ms':>10}{'p99 ms':>10}"
+        ]
+        for name, stats in summary["spans"].items():
+            lines.append(f"{name:<16}{stats['count']:>8}"
+                         f"{stats['total_ms']:>12.2f}{stats['mean_ms']:>10.3f}"
+                         f"{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}")
+        for name, value in summary["counters"].items():
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
@@ -0,0 +1,164 @@
+import argparse
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import openvino as ov
+
+from chatglm2.modeling import ChatGLMModel
+from qwen.modeling import QwenModel
+from baichuan2.modeling import BaichuanModel
+from internlm.modeling import InternLMModel
+from context import messages_to_history
+from synthetic import load_tokenizer
+
+
+def load_prompts(calibration_path, num_prompts: int):
+    """
+    (system, history, query) of the first `num_prompts` records of a JSONL
+    file, each holding either OpenAI style chat `messages` or a `prompt`
+    """
+    prompts = []
+    with open(calibration_path) as calibration_file:
+        for line in calibration_file:
+            if len(prompts) >= num_prompts:
+                break
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "messages" in record:
+                prompts.append(messages_to_history(record["messages"]))
+            elif "prompt" in record:
+                prompts.append(("", [], record["prompt"]))
+            else:
+                raise ValueError(
+                    "calibration records need 'messages' or 'prompt'")
+    return prompts
+
+
+class CalibrationDataset():
+    """
+    Model inputs of the prefill of every calibration prompt, formatted by
+    the `build_inputs` of the model class, and of the `decode_steps` greedy
+    decode steps after it, with the `past_key_values` the FP model
+    produced. Samples are recomputed on every pass instead of being kept,
+    since each decode sample holds a whole KV-cache.
+    """
+
+    def __init__(self, ov_model, prompts, decode_steps: int = 2) -> None:
+        self.ov_model = ov_model
+        self.prompts = prompts
+        self.decode_steps = decode_steps
+
+    def __len__(self):
+        return len(self.prompts) * (self.decode_steps + 1)
+
+    def __iter__(self):
+        engine = self.ov_model.engine
+        for system, history, query in self.prompts:
+            input_ids = self.ov_model.build_inputs(history, query, system)
+            past_key_values, past_length = engine.empty_past(), 0
+            for _ in range(self.decode_steps + 1):
+                yield engine.prepare_inputs(input_ids, past_key_values,
+                                            past_length)
+                with engine.requests.checkout() as request:
+                    logits, past_key_values = engine.forward(
+                        input_ids, past_key_values, past_length,
+                        request=request)
+                    next_token = engine.sampler.sample(logits[:, -1], top_k=1)
+                    past_key_values = {
+                        name: value.copy()
+                        for name, value in past_key_values.items()
+                    }
+                past_length += input_ids.shape[1]
+                input_ids = np.asarray(next_token, dtype=np.int64)[:, None]
+
+
+def quantize_model(ir_model, dataset: CalibrationDataset, preset: str = "mixed"):
+    """
+    NNCF post-training quantization of weights and activations to INT8
+    """
+    import nncf
+    model = ov.Core().read_model(ir_model)
+    return nncf.quantize(model,
+                         nncf.Dataset(dataset),
+                         preset=nncf.QuantizationPreset(preset),
+                         subset_size=len(dataset),
+                         model_type=nncf.ModelType.TRANSFORMER)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h',
+                        '--help',
+                        action='help',
+                        help='Show this help message and exit.')
+    parser.add_argument('-m',
+                        '--model_path',
+                        required=True,
+                        type=str,
+                        help='Required. directory of the exported FP16 IR')
+    parser.add_argument('-c',
+                        '--calibration',
+                        required=True,
+                        type=str,
+                        help='Required. JSONL file of prompts, one {"messages": [...]} or {"prompt": "..."} per line')
+    parser.add_argument('-o',
+                        '--output',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. directory of the quantized IR, defaults to the model path with an _int8 suffix')
+    parser.add_argument('-d',
+                        '--device',
+                        default='CPU',
+                        required=False,
+                        type=str,
+                        help='Optional. device computing the KV-cache of the calibration samples')
+    parser.add_argument('-n',
+                        '--num_prompts',
+                        default=128,
+                        required=False,
+                        type=int,
+                        help='Optional. number of calibration prompts')
+    parser.add_argument('-ds',
+                        '--decode_steps',
+                        default=2,
+                        required=False,
+                        type=int,
+                        help='Optional. decode steps calibrated after the prefill of every prompt')
+    parser.add_argument('--preset',
+                        default='mixed',
+                        choices=('mixed', 'performance'),
+                        help='Optional. mixed quantizes activations asymmetrically, performance symmetrically')
+    args = parser.parse_args()
+
+    model_path = Path(args.model_path)
+    output_path = Path(args.output or f"{model_path}_int8")
+    model_id = str(model_path)
+    tokenizer = load_tokenizer(model_id)
+    if 'chatglm2' in model_id:
+        ov_model = ChatGLMModel(model_id, args.device, tokenizer=tokenizer)
+    elif 'qwen' in model_id:
+        ov_model = QwenModel(model_id, args.device, tokenizer=tokenizer)
+    elif 'baichuan2' in model_id:
+        ov_model = BaichuanModel(model_id, args.device, tokenizer=tokenizer)
+    elif 'internlm' in model_id:
+        ov_model = InternLMModel(model_id, args.device, tokenizer=tokenizer)
+    else:
+        raise NotImplementedError(f"Unsupported model id {model_id!r}")
+
+    prompts = load_prompts(args.calibration, args.num_prompts)
+    dataset = CalibrationDataset(ov_model, prompts, args.decode_steps)
+    ir_model = next(model_path.glob("*.xml"))
+    print(f" --- quantizing with {len(dataset)} calibration samples --- ")
+    quantized_model = quantize_model(ir_model, dataset, args.preset)
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    ov.save_model(quantized_model, output_path / ir_model.name)
+    # tokenizer files and whatever else the model class loads
+    for path in model_path.iterdir():
+        if path.is_file() and path.suffix not in (".xml", ".bin"):
+            shutil.copy(path, output_path / path.name)
+    print(f"saved to {output_path}")
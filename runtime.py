@@ -0,0 +1,276 @@
+import os
+import time
+from pathlib import Path
+
+
+class LoadTimings():
+    """
+    Wall clock seconds spent on reading the IR, compiling it and on the first
+    inference, the latter is filled in by the engine. When compiling through
+    the model cache, reading is part of `compile`.
+    """
+
+    def __init__(self) -> None:
+        self.read = 0.0
+        self.compile = 0.0
+        self.first_inference = None
+        self.from_cache = False
+
+    def as_dict(self):
+        return {
+            "read_s": self.read,
+            "compile_s": self.compile,
+            "first_inference_s": self.first_inference,
+            "from_cache": self.from_cache,
+        }
+
+    def report(self):
+        source = "cache" if self.from_cache else "IR"
+        text = (f"read {self.read:.2f} s, compile {self.compile:.2f} s "
+                f"(from {source})")
+        if self.first_inference is not None:
+            text += f", first inference {self.first_inference:.2f} s"
+        return text
+
+
+class RuntimeConfig():
+    """
+    Compile time settings of the OpenVINO device plugin. Every field left as
+    None keeps the plugin default. `PRESETS` hold tuned starting points:
+
+    - "interactive": one user waiting for each token, a single latency
+      stream on physical cores only
+    - "throughput": many concurrent sequences, as many streams as the
+      machine supports, each served by its own infer request
+    """
+
+    PERFORMANCE_HINTS = ("LATENCY", "THROUGHPUT", "CUMULATIVE_THROUGHPUT")
+    PRESETS = {
+        "interactive": {
+            "performance_hint": "LATENCY",
+            "num_streams": 1,
+            "enable_hyper_threading": False,
+            "enable_cpu_pinning": True,
+        },
+        "throughput": {
+            "performance_hint": "THROUGHPUT",
+            "enable_hyper_threading": True,
+            "enable_cpu_pinning": True,
+        },
+    }
+
+    def __init__(self,
+                 performance_hint: str = None,
+                 num_threads: int = None,
+                 num_streams: int = None,
+                 enable_hyper_threading: bool = None,
+                 enable_cpu_pinning: bool = None,
+                 inference_precision: str = None) -> None:
+        if performance_hint not in (None, ) + self.PERFORMANCE_HINTS:
+            raise ValueError(
+                f"Unknown performance hint {performance_hint!r}, expected one "
+                f"of {self.PERFORMANCE_HINTS}")
+        self.performance_hint = performance_hint
+        self.num_threads = num_threads
+        self.num_streams = num_streams
+        self.enable_hyper_threading = enable_hyper_threading
+        self.enable_cpu_pinning = enable_cpu_pinning
+        self.inference_precision = inference_precision
+
+    @classmethod
+    def preset(cls, name: str, **overrides):
+        if name not in cls.PRESETS:
+            raise ValueError(f"Unknown runtime preset {name!r}, expected one "
+                             f"of {tuple(cls.PRESETS)}")
+        settings = dict(cls.PRESETS[name])
+        settings.update(
+            {key: value for key, value in overrides.items() if value is not None})
+        return cls(**settings)
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Builds the config from the options added by `add_runtime_args`
+        """
+        on_off = {'on': True, 'off': False}
+        settings = {
+            "performance_hint": args.performance_hint,
+            "num_threads": args.num_threads,
+            "num_streams": args.num_streams,
+            "enable_hyper_threading": on_off.get(args.hyper_threading),
+            "enable_cpu_pinning": on_off.get(args.cpu_pinning),
+            "inference_precision": args.inference_precision,
+        }
+        if args.preset is not None:
+            return cls.preset(args.preset, **settings)
+        return cls(**settings)
+
+    def properties(self):
+        """
+        The settings as `compile_model` config
+        """
+        properties = {
+            "PERFORMANCE_HINT": self.performance_hint,
+            "INFERENCE_NUM_THREADS": self.num_threads,
+            "NUM_STREAMS": self.num_streams,
+            "ENABLE_HYPER_THREADING": self.enable_hyper_threading,
+            "ENABLE_CPU_PINNING": self.enable_cpu_pinning,
+            "INFERENCE_PRECISION_HINT": self.inference_precision,
+        }
+        return {
+            name: value
+            for name, value in properties.items() if value is not None
+        }
+
+
+def add_runtime_args(parser, preset: str = None):
+    """
+    Adds the `RuntimeConfig` options to a CLI argument parser, `preset` is
+    the default of --preset
+    """
+    parser.add_argument('--preset',
+                        default=preset,
+                        required=False,
+                        choices=tuple(RuntimeConfig.PRESETS),
+                        help='Optional. runtime settings tuned for one interactive user or for batched throughput')
+    parser.add_argument('--performance_hint',
+                        default=None,
+                        required=False,
+                        choices=RuntimeConfig.PERFORMANCE_HINTS,
+                        help='Optional. OpenVINO performance hint')
+    parser.add_argument('--num_threads',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. number of inference threads')
+    parser.add_argument('--num_streams',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. number of parallel inference streams')
+    parser.add_argument('--hyper_threading',
+                        default=None,
+                        required=False,
+                        choices=('on', 'off'),
+                        help='Optional. run inference threads on hyper-threading siblings')
+    parser.add_argument('--cpu_pinning',
+                        default=None,
+                        required=False,
+                        choices=('on', 'off'),
+                        help='Optional. pin inference threads to CPU cores')
+    parser.add_argument('--inference_precision',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. inference precision hint, e.g. f32 or bf16')
+    return parser
+
+
+def _cache_blobs(cache_dir):
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return set()
+    return {name for name in os.listdir(cache_dir) if name.endswith(".blob")}
+
+
+def _read_proc_fields(path):
+    fields = {}
+    try:
+        with open(path) as proc_file:
+            for line in proc_file:
+                name, _, value = line.partition(":")
+                value = value.split()
+                if len(value) == 2 and value[1] == "kB":
+                    fields[name] = int(value[0]) * 1024
+    except OSError:
+        pass
+    return fields
+
+
+def memory_usage(pid="self"):
+    """
+    Resident memory of a process in bytes, split into what only this process
+    holds and what is shared with others, e.g. memory mapped weights in the
+    page cache used by several workers. `pss` charges every shared page
+    proportionally to the processes mapping it, so summing it over workers
+    gives the real footprint. Values are None where /proc is unavailable.
+    """
+    status = _read_proc_fields(f"/proc/{pid}/status")
+    rollup = _read_proc_fields(f"/proc/{pid}/smaps_rollup")
+    shared = None
+    if "Shared_Clean" in rollup:
+        shared = rollup["Shared_Clean"] + rollup.get("Shared_Dirty", 0)
+    private = None
+    if "Private_Clean" in rollup:
+        private = rollup["Private_Clean"] + rollup.get("Private_Dirty", 0)
+    return {
+        "rss": status.get("VmRSS"),
+        "peak_rss": status.get("VmHWM"),
+        "anonymous": status.get("RssAnon"),
+        "file": status.get("RssFile"),
+        "shared": shared,
+        "private": private,
+        "pss": rollup.get("Pss"),
+    }
+
+
+def reset_peak_rss():
+    """
+    Restarts the peak RSS (VmHWM) accounting of this process, returns False
+    where the kernel does not support it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def format_memory(usage):
+    return ", ".join(f"{name} {value / (1 << 20):.0f} MB"
+                     for name, value in usage.items() if value is not None)
+
+
+def load_model(core,
+               ir_model,
+               device: str = 'CPU',
+               cache_dir: str = None,
+               mmap: bool = True,
+               config: RuntimeConfig = None):
+    """
+    Reads and compiles `ir_model`, returns the compiled model and its
+    `LoadTimings`. With a `cache_dir` OpenVINO exports the compiled blob on
+    the first run and imports it afterwards, skipping both reading the IR and
+    compiling it.
+
+    With `mmap` the weights file is memory mapped instead of read into
+    process memory, so worker processes on one host share its page cache
+    pages for every weight the device plugin does not repack. The
+    properties of `config` are applied at compile time.
+    """
+    timings = LoadTimings()
+    properties = config.properties() if config is not None else {}
+    core.set_property({"ENABLE_MMAP": mmap})
+    if cache_dir is not None:
+        core.set_property({"CACHE_DIR": str(cache_dir)})
+        blobs = _cache_blobs(cache_dir)
+        print(" --- model compiling (cached) --- ")
+        start = time.perf_counter()
+        compiled_model = core.compile_model(str(Path(ir_model)), device,
+                                            properties)
+        timings.compile = time.perf_counter() - start
+        # a cache miss exports a new blob
+        timings.from_cache = blobs == _cache_blobs(cache_dir) and bool(blobs)
+        return compiled_model, timings
+    print(" --- reading model --- ")
+    start = time.perf_counter()
+    # read the model and corresponding weights from file
+    model = core.read_model(ir_model)
+    timings.read = time.perf_counter() - start
+    print(" --- model compiling --- ")
+    start = time.perf_counter()
+    compiled_model = core.compile_model(model=model,
+                                        device_name=device,
+                                        config=properties)
+    timings.compile = time.perf_counter() - start
+    return compiled_model, timings
@@ -0,0 +1,554 @@
+import threading
+import time
+import traceback
+from collections import deque
+
+import numpy as np
+
+from engine import GenerationEngine
+from kv_cache import KVCacheBuffer, KVCacheExhausted
+
+
+class GenerationTask():
+    """
+    One sequence submitted to the `BatchScheduler`. `on_token` is called from
+    the scheduler thread for every generated token and `on_finish` once the
+    sequence is finished, `wait` blocks until then.
+    """
+
+    def __init__(self,
+                 input_ids,
+                 max_generated_tokens=100,
+                 top_k=20,
+                 top_p=0.7,
+                 temperature=1,
+                 on_token=None,
+                 on_finish=None) -> None:
+        self.prompt_tokens = np.asarray(input_ids, dtype=np.int64)[0]
+        self.max_generated_tokens = max_generated_tokens
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.on_token = on_token
+        self.on_finish = on_finish
+        self.output_tokens = []
+        # blocks reserved in the engine's KVBlockPool while running
+        self.block_table = None
+        # "stop", "length", "cancelled", "rejected" or "error" once finished
+        self.finish_reason = None
+        self.cancelled = False
+        # perf_counter_ns of the submission and of the latest token
+        self.submitted_at = None
+        self.last_token_at = None
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.finish_reason is not None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _append(self, token: int, is_stop: bool):
+        if is_stop:
+            self._finish("stop")
+            return
+        self.output_tokens.append(token)
+        if self.on_token is not None:
+            self.on_token(self, token)
+        if len(self.output_tokens) >= self.max_generated_tokens:
+            self._finish("length")
+
+    def _finish(self, reason: str):
+        self.finish_reason = reason
+        self._done.set()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+
+class PrefillState():
+    """
+    Progress of a prompt prefilled in chunks: the KV-cache of the first
+    `position` prompt tokens behind `padding` masked positions
+    """
+
+    def __init__(self, task: GenerationTask, padding: int) -> None:
+        self.task = task
+        self.padding = padding
+        self.position = 0
+        self.past_key_values = None
+
+    @property
+    def done(self):
+        return self.position >= len(self.task.prompt_tokens)
+
+
+class BatchScheduler():
+    """
+    Continuous batching: the decode steps of all running sequences are merged
+    into one batched inference, new sequences are admitted and finished ones
+    retired between steps.
+
+    Every row of the batch shares one KV length. A new sequence is
+    prefilled behind masked zero padding up to that length. Models exported
+    with `position_ids` next to the `attention_mask` give every row its own
+    positions, so a longer prompt instead pads the running rows on the left,
+    and the leading columns left masked in every row once sequences retire
+    are dropped. Without them, rotary positions follow the KV length: a
+    longer prompt waits until the batch has grown to its length and columns
+    cannot be dropped. ChatGLM2 takes no attention_mask, its rows can only
+    be batched with prompts of exactly the batch KV length. New sequences
+    are not admitted while the batch would outgrow the `context_length` of
+    the model, it drains and starts over at length 0 instead. A sequence
+    whose prompt and `max_generated_tokens` exceed the context on their own
+    is rejected.
+
+    With a `prefill_chunk_size` on the engine, a longer prompt is prefilled
+    one chunk per step, between the decode steps of the running batch, and
+    joins the batch with the last chunk. Its padding accounts for the decode
+    steps taken meanwhile. One prompt is prefilled in chunks at a time.
+
+    If the engine has a `KVBlockPool`, a sequence is only admitted once the
+    blocks for its padding, its prompt and all of its tokens are reserved,
+    otherwise it stays queued; one that could never fit into the pool is
+    rejected. The batch keeps its KV-cache in arrays of its own and never
+    writes the reserved blocks, the reservations count its rows against the
+    pool budget instead. Pool pages are only committed by the OS once
+    written, so while the pool serves nothing but batches its resident
+    KV-cache memory stays within the budget plus the `present.*` outputs of
+    the step in flight. Blocks written earlier, e.g. by chat sessions or the
+    prefix cache, stay resident next to the batch arrays.
+    """
+
+    def __init__(self,
+                 engine: GenerationEngine,
+                 max_batch_size: int = 8) -> None:
+        self.engine = engine
+        self.adapter = engine.adapter
+        self.max_batch_size = max_batch_size if engine.supports_batching else 1
+        self.waiting = deque()
+        self.running = []
+        self.past_key_values = None
+        self.past_length = 0
+        self.attention_mask = None
+        self.next_tokens = None
+        # decode steps write the KV-cache into this buffer, it is loaded
+        # again whenever the rows of the batch change and freed once the
+        # batch drains or shrinks to less than half of it
+        self.kv_buffer = None
+        self._kv_loaded = False
+        # PrefillState of the prompt prefilled in chunks
+        self.prefilling = None
+        # infer request checked out of the engine's pool while not idle
+        self.request = None
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def submit(self, task: GenerationTask):
+        task.submitted_at = task.last_token_at = time.perf_counter_ns()
+        with self._condition:
+            self.waiting.append(task)
+            self._condition.notify()
+        return task
+
+    @property
+    def num_active(self):
+        prefilling = 1 if self.prefilling is not None else 0
+        return len(self.waiting) + len(self.running) + prefilling
+
+    def _num_chunks(self, task: GenerationTask):
+        chunk_size = self.engine.prefill_chunk_size
+        if not chunk_size:
+            return 1
+        return -(-len(task.prompt_tokens) // chunk_size)
+
+    def _can_admit(self, task: GenerationTask):
+        num_chunks = self._num_chunks(task)
+        if self.prefilling is not None and (num_chunks > 1 or
+                                            not self.running):
+            # the prompt being prefilled joins the batch first
+            return False
+        if not self.running:
+            return True
+        # the batch takes one decode step per chunk but the last
+        merge_length = self.past_length + num_chunks - 1
+        prompt_length = len(task.prompt_tokens)
+        if self.engine.row_positions:
+            return True
+        if self.adapter.use_attention_mask:
+            return prompt_length <= merge_length
+        return prompt_length == merge_length
+
+    def _fits_context(self, task: GenerationTask, merge_length: int):
+        """
+        Whether the batch stays within the context of the model until its
+        last sequence is done if `task` joins it at `merge_length`, or `task`
+        alone when the batch is empty
+        """
+        context_length = self.adapter.context_length
+        if context_length is None:
+            return True
+        remaining = [
+            running.max_generated_tokens - len(running.output_tokens)
+            for running in self.running
+        ]
+        return merge_length + max(remaining +
+                                  [task.max_generated_tokens]) <= context_length
+
+    def _reserve(self, task: GenerationTask, padding: int):
+        """
+        Reserves the pool blocks of `task` behind `padding` masked positions,
+        returns False if it has to wait
+        """
+        pool = self.engine.kv_pool
+        if pool is None:
+            return True
+        length = len(task.prompt_tokens) + task.max_generated_tokens
+        if pool.blocks_needed(length) > pool.num_blocks:
+            self._reject(task)
+            return False
+        try:
+            task.block_table = self.engine.reserve_blocks(padding + length)
+        except KVCacheExhausted:
+            return False
+        return True
+
+    def _reject(self, task: GenerationTask):
+        with self._condition:
+            self.waiting.remove(task)
+        task._finish("rejected")
+        if self.engine.metrics is not None:
+            self.engine.metrics.end("rejected")
+
+    def _release(self, task: GenerationTask):
+        if task.block_table is not None:
+            task.block_table.release()
+            task.block_table = None
+        if self.engine.metrics is not None:
+            self.engine.metrics.end(
+                task.finish_reason,
+                (time.perf_counter_ns() - task.submitted_at) * 1e-9)
+
+    def _append(self, task: GenerationTask, token: int):
+        is_stop = self.adapter.is_stop_token(token)
+        metrics = self.engine.metrics
+        if metrics is not None and not is_stop:
+            now = time.perf_counter_ns()
+            metrics.token((now - task.last_token_at) * 1e-9,
+                          not task.output_tokens)
+            task.last_token_at = now
+        task._append(token, is_stop)
+
+    def _prefill(self, state: PrefillState):
+        """
+        Feeds the next chunk of the prompt of `state`. Once the whole prompt
+        is in, samples the first token and returns the KV-cache, attention
+        mask and token to merge into the batch, otherwise None.
+        """
+        task = state.task
+        chunk_size = self.engine.prefill_chunk_size or len(task.prompt_tokens)
+        input_ids = task.prompt_tokens[None,
+                                       state.position:state.position + chunk_size]
+        past_length = state.padding + state.position
+        past_key_values = state.past_key_values
+        if past_key_values is None:
+            past_key_values = self.engine.empty_past(1, state.padding)
+        attention_mask = np.concatenate(
+            (np.zeros((1, state.padding), dtype=np.int64),
+             np.ones((1, state.position + input_ids.shape[1]),
+                     dtype=np.int64)),
+            axis=-1)
+        profiler = self.engine.profiler
+        with profiler.span("prefill"):
+            logits, state.past_key_values = self.engine.forward(
+                input_ids,
+                past_key_values,
+                past_length,
+                attention_mask,
+                request=self.request)
+        state.position += input_ids.shape[1]
+        if not state.done:
+            return None
+        with profiler.span("sample"):
+            next_token = self.engine.sampler.sample(
+                logits[:, -1],
+                top_k=task.top_k,
+                top_p=task.top_p,
+                temperature=task.temperature)[0].item()
+        self._append(task, next_token)
+        return state.past_key_values, attention_mask, next_token
+
+    def _join(self, task: GenerationTask, past_key_values, attention_mask,
+              next_token: int):
+        """
+        Adds a prefilled sequence to the running batch
+        """
+        if task.finished:
+            self._release(task)
+            return
+        if not self.running:
+            self.past_key_values = past_key_values
+            self.past_length = attention_mask.shape[1]
+            self.attention_mask = attention_mask
+            self.next_tokens = [next_token]
+        else:
+            # the shorter side is padded, with row positions the batch may
+            # be shorter than the new row or have been trimmed meanwhile
+            length = attention_mask.shape[1]
+            if length < self.past_length:
+                past_key_values, attention_mask = self._pad_left(
+                    past_key_values, attention_mask, self.past_length - length)
+            elif length > self.past_length:
+                self.past_key_values, self.attention_mask = self._pad_left(
+                    self.past_key_values, self.attention_mask,
+                    length - self.past_length)
+                self.past_length = length
+            self.past_key_values = {
+                name: np.concatenate((self.past_key_values[name], value),
+                                     axis=self.adapter.kv_batch_axis)
+                for name, value in past_key_values.items()
+            }
+            self.attention_mask = np.concatenate(
+                (self.attention_mask, attention_mask), axis=0)
+            self.next_tokens.append(next_token)
+        self.running.append(task)
+        self._kv_loaded = False
+
+    def _pad_left(self, past_key_values, attention_mask, num_columns: int):
+        """
+        Prepends `num_columns` masked zero positions to every row
+        """
+        padding = self.engine.empty_past(attention_mask.shape[0], num_columns)
+        past_key_values = {
+            name: np.concatenate((padding[name].data, value),
+                                 axis=self.adapter.kv_seq_axis)
+            for name, value in past_key_values.items()
+        }
+        attention_mask = np.concatenate(
+            (np.zeros((attention_mask.shape[0], num_columns), dtype=np.int64),
+             attention_mask),
+            axis=-1)
+        return past_key_values, attention_mask
+
+    def _trim(self):
+        """
+        Drops the leading columns masked in every row, e.g. the padding of
+        a longer sequence that retired
+        """
+        num_columns = int(np.argmax(self.attention_mask.any(axis=0)))
+        if not num_columns:
+            return
+        index = [slice(None)] * 4
+        index[self.adapter.kv_seq_axis] = slice(num_columns, None)
+        self.past_key_values = {
+            name: np.ascontiguousarray(value[tuple(index)])
+            for name, value in self.past_key_values.items()
+        }
+        self.attention_mask = np.ascontiguousarray(
+            self.attention_mask[:, num_columns:])
+        self.past_length -= num_columns
+
+    def _continue_prefill(self):
+        state = self.prefilling
+        if state.task.cancelled:
+            self.prefilling = None
+            state.task._finish("cancelled")
+            self._release(state.task)
+            return
+        prefilled = self._prefill(state)
+        if prefilled is not None:
+            self.prefilling = None
+            self._join(state.task, *prefilled)
+
+    def _admit(self):
+        if self.prefilling is not None:
+            self._continue_prefill()
+        with self._condition:
+            candidates = list(self.waiting)
+        for task in candidates:
+            if len(self.running) >= self.max_batch_size:
+                break
+            if self.prefilling is not None and len(
+                    self.running) + 1 >= self.max_batch_size:
+                break
+            if task.cancelled or not self._can_admit(task):
+                continue
+            padding = 0
+            if self.running:
+                padding = max(
+                    self.past_length + self._num_chunks(task) - 1 -
+                    len(task.prompt_tokens), 0)
+            if not self._fits_context(task,
+                                      padding + len(task.prompt_tokens)):
+                if not self.running:
+                    # longer than the context on its own
+                    self._reject(task)
+                    continue
+                # drain the batch, its KV length starts over once it is empty
+                break
+            if not self._reserve(task, padding):
+                if task.finished:
+                    continue
+                # first come, first served while the pool is exhausted
+                break
+            with self._condition:
+                self.waiting.remove(task)
+            if self.engine.metrics is not None:
+                self.engine.metrics.begin(len(task.prompt_tokens))
+            state = PrefillState(task, padding)
+            prefilled = self._prefill(state)
+            if prefilled is None:
+                self.prefilling = state
+                continue
+            self._join(task, *prefilled)
+        # cancelled tasks that never started
+        with self._condition:
+            for task in [task for task in self.waiting if task.cancelled]:
+                self.waiting.remove(task)
+                task._finish("cancelled")
+                if self.engine.metrics is not None:
+                    self.engine.metrics.end("cancelled")
+
+    def _retire(self):
+        for task in self.running:
+            if task.cancelled and not task.finished:
+                task._finish("cancelled")
+            if task.finished:
+                self._release(task)
+        keep = [
+            idx for idx, task in enumerate(self.running) if not task.finished
+        ]
+        if len(keep) == len(self.running):
+            return
+        self.running = [self.running[idx] for idx in keep]
+        self.next_tokens = [self.next_tokens[idx] for idx in keep]
+        self._kv_loaded = False
+        if not self.running:
+            self.past_key_values = None
+            self.attention_mask = None
+            self.past_length = 0
+            # the next batch allocates what it needs, nothing is held idle
+            self.kv_buffer = None
+            return
+        self.past_key_values = {
+            name: np.take(value, keep, axis=self.adapter.kv_batch_axis)
+            for name, value in self.past_key_values.items()
+        }
+        self.attention_mask = self.attention_mask[keep]
+        if self.engine.row_positions:
+            self._trim()
+        needed = len(self.running) * (self.past_length + 1)
+        if (self.kv_buffer is not None
+                and self.kv_buffer.num_positions > 2 * needed):
+            # the batch shrank to less than half of the buffer
+            self.kv_buffer = None
+
+    def _decode(self):
+        batch_size = len(self.running)
+        input_ids = np.array(self.next_tokens, dtype=np.int64).reshape(
+            batch_size, 1)
+        self.attention_mask = np.concatenate(
+            (self.attention_mask, np.ones((batch_size, 1), dtype=np.int64)),
+            axis=-1)
+        profiler = self.engine.profiler
+        with profiler.span("decode"):
+            if self.kv_buffer is None:
+                self.kv_buffer = KVCacheBuffer(self.engine, batch_size,
+                                               self.past_length + 1)
+            if not self._kv_loaded:
+                self.kv_buffer.load(self.past_key_values, self.past_length,
+                                    batch_size)
+            logits, self.past_key_values = self.engine.forward(
+                input_ids,
+                self.past_key_values,
+                self.past_length,
+                self.attention_mask,
+                kv_buffer=self.kv_buffer,
+                request=self.request)
+            self._kv_loaded = True
+        self.past_length += 1
+        with profiler.span("sample"):
+            next_tokens = self.engine.sampler.sample(
+                logits[:, -1],
+                top_k=[task.top_k for task in self.running],
+                top_p=[task.top_p for task in self.running],
+                temperature=[task.temperature
+                             for task in self.running]).tolist()
+        profiler.count("batched_tokens", batch_size)
+        for task, next_token in zip(self.running, next_tokens):
+            self._append(task, next_token)
+        self.next_tokens = next_tokens
+
+    def step(self):
+        """
+        Retires finished sequences, admits waiting ones and runs one batched
+        decode step. Returns False when there is nothing left to do.
+        """
+        if self.request is None:
+            self.request = self.engine.requests.acquire()
+        with self.engine.profiler.span("schedule"):
+            self._retire()
+            self._admit()
+            self._retire()
+        if self.running:
+            self._decode()
+        if self.num_active == 0:
+            self.engine.requests.release(self.request)
+            self.request = None
+            return False
+        return True
+
+    def run(self):
+        """
+        Steps until every submitted sequence is finished
+        """
+        while self.step():
+            pass
+
+    def _fail(self):
+        """
+        Finishes the running and prefilling sequences with "error" after a
+        step raised, waiting ones start over with an empty batch
+        """
+        tasks = list(self.running)
+        if self.prefilling is not None:
+            tasks.append(self.prefilling.task)
+        for task in tasks:
+            if not task.finished:
+                task._finish("error")
+            self._release(task)
+        self.running = []
+        self.prefilling = None
+        self.past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+        self.past_length = 0
+        self.kv_buffer = None
+        self._kv_loaded = False
+        if self.request is not None:
+            self.engine.requests.release(self.request)
+            self.request = None
+
+    def serve_forever(self):
+        """
+        Scheduling loop for a background thread, sleeps while idle. A failed
+        step finishes the sequences it was running with "error" and the loop
+        goes on.
+        """
+        while not self._stopped:
+            with self._condition:
+                while self.num_active == 0 and not self._stopped:
+                    self._condition.wait()
+            try:
+                self.step()
+            except Exception:
+                traceback.print_exc()
+                self._fail()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
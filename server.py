@@ -0,0 +1,457 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from context import messages_to_history
+from chatglm2.modeling import ChatGLMModel
+from qwen.modeling import QwenModel
+from baichuan2.modeling import BaichuanModel
+from internlm.modeling import InternLMModel
+from synthetic import load_tokenizer
+from kv_cache import KVBlockPool
+from metrics import (CONTENT_TYPE, GenerationMetrics, MetricsRegistry,
+                     add_process_metrics)
+from runtime import RuntimeConfig, add_runtime_args, memory_usage
+from scheduler import BatchScheduler, GenerationTask
+from utils import IncrementalDetokenizer, IncrementalResponseProcessor
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+MAX_BODY_SIZE = 1 << 20
+MODEL_CLASSES = {
+    "chatglm2": ChatGLMModel,
+    "qwen": QwenModel,
+    "baichuan2": BaichuanModel,
+    "internlm": InternLMModel,
+}
+ENDPOINTS = ("/health", "/metrics", "/v1/models", "/v1/chat/completions")
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+    def body(self):
+        return {
+            "error": {
+                "message": self.message,
+                "type": REASONS[self.status].lower().replace(" ", "_"),
+                "code": self.status,
+            }
+        }
+
+
+class ChatCompletionServer():
+    """
+    OpenAI compatible `/v1/chat/completions` endpoint on top of asyncio
+    streams, without third party dependencies. Generation runs in a
+    `BatchScheduler` thread so concurrent requests share batched decode steps
+    and the event loop never blocks on inference. Requests beyond
+    `max_queue_size` waiting ones are refused with 429, a client closing its
+    connection cancels its generation. `/metrics` exposes the `registry` in
+    the Prometheus text format.
+    """
+
+    def __init__(self,
+                 ov_model,
+                 model_name: str,
+                 max_batch_size: int = 8,
+                 max_queue_size: int = 32,
+                 max_tokens: int = 256,
+                 registry: MetricsRegistry = None) -> None:
+        self.ov_model = ov_model
+        self.model_name = model_name
+        self.max_queue_size = max_queue_size
+        self.max_tokens = max_tokens
+        self.scheduler = BatchScheduler(ov_model.engine, max_batch_size)
+        if registry is None:
+            registry = add_process_metrics(MetricsRegistry())
+        self.registry = registry
+        GenerationMetrics(self.registry).attach(
+            ov_model.engine).attach_scheduler(self.scheduler)
+        self.http_requests = self.registry.counter(
+            "ov_http_requests_total", "HTTP requests served",
+            ("path", "status"))
+        self._thread = threading.Thread(target=self.scheduler.serve_forever,
+                                        daemon=True)
+
+    async def serve(self, host: str, port: int):
+        self._thread.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f" --- serving on http://{host}:{port}/v1/chat/completions --- ")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.scheduler.stop()
+
+    async def handle(self, reader, writer):
+        path, status = None, 200
+        try:
+            method, path, body = await self.read_request(reader)
+            if path == "/health":
+                await self.send_json(writer, 200, {
+                    "status": "ok",
+                    "memory": memory_usage()
+                })
+            elif path == "/metrics":
+                body = self.registry.expose().encode()
+                await self.send_headers(writer, 200, CONTENT_TYPE,
+                                        [f"Content-Length: {len(body)}"])
+                writer.write(body)
+                await writer.drain()
+            elif path == "/v1/models":
+                await self.send_json(writer, 200, {
+                    "object": "list",
+                    "data": [{"id": self.model_name, "object": "model"}]
+                })
+            elif path == "/v1/chat/completions":
+                if method != "POST":
+                    raise HTTPError(405, "use POST")
+                await self.chat_completions(reader, writer, body)
+            else:
+                raise HTTPError(404, f"Unknown path {path!r}")
+        except HTTPError as error:
+            status = error.status
+            await self.send_error(writer, error)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # client closed the connection
+            status = 499
+        finally:
+            writer.close()
+            self.http_requests.labels(
+                path=path if path in ENDPOINTS else "other",
+                status=status).inc()
+
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise HTTPError(400, "malformed request line")
+        method, path, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, "request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, path.split("?")[0], body
+
+    def parse_request(self, body: bytes):
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise HTTPError(400, "request body is not valid JSON")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "request body must be a JSON object")
+        try:
+            system, history, query = messages_to_history(
+                request.get("messages"))
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        try:
+            max_tokens = int(request.get("max_tokens") or self.max_tokens)
+            top_k = int(request.get("top_k", 20))
+            top_p = float(request.get("top_p", 0.7))
+            temperature = max(float(request.get("temperature", 1)), 1e-5)
+        except (TypeError, ValueError):
+            raise HTTPError(400, "invalid sampling parameters")
+        if max_tokens < 1:
+            raise HTTPError(400, "'max_tokens' must be at least 1")
+        if top_k < 1:
+            raise HTTPError(400, "'top_k' must be at least 1")
+        if not 0 < top_p <= 1:
+            raise HTTPError(400, "'top_p' must be in (0, 1]")
+        try:
+            input_ids = self.ov_model.build_inputs(
+                history, query, system, max_generated_tokens=max_tokens)
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        task = GenerationTask(input_ids,
+                              max_generated_tokens=max_tokens,
+                              top_k=top_k,
+                              top_p=top_p,
+                              temperature=temperature)
+        return request, task
+
+    async def chat_completions(self, reader, writer, body: bytes):
+        loop = asyncio.get_running_loop()
+        # tokenizing a long history would stall every other connection
+        request, task = await loop.run_in_executor(None, self.parse_request,
+                                                   body)
+        if len(self.scheduler.waiting) >= self.max_queue_size:
+            raise HTTPError(429, "too many queued requests, retry later")
+        context_length = self.ov_model.engine.adapter.context_length
+        if context_length is not None and len(
+                task.prompt_tokens) + task.max_generated_tokens > context_length:
+            raise HTTPError(
+                400, f"prompt and 'max_tokens' exceed the context of "
+                f"{context_length} tokens")
+        kv_pool = self.ov_model.engine.kv_pool
+        if kv_pool is not None and kv_pool.blocks_needed(
+                len(task.prompt_tokens) +
+                task.max_generated_tokens) > kv_pool.num_blocks:
+            raise HTTPError(503, "request does not fit into the KV-cache")
+
+        events = asyncio.Queue()
+        task.on_token = lambda task, token: loop.call_soon_threadsafe(
+            events.put_nowait, token)
+        task.on_finish = lambda task: loop.call_soon_threadsafe(
+            events.put_nowait, None)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        stream = bool(request.get("stream", False))
+
+        # nothing else is sent by the client, end of stream means it left
+        disconnected = asyncio.ensure_future(reader.read(1))
+        self.scheduler.submit(task)
+        try:
+            if stream:
+                await self.send_headers(writer, 200, "text/event-stream")
+            content = []
+            async for text in self.stream_text(task, events, disconnected):
+                if not stream:
+                    content.append(text)
+                    continue
+                await self.send_event(
+                    writer,
+                    self.chunk(completion_id, created, {"content": text}))
+            if task.finish_reason == "error":
+                error = HTTPError(500, "generation failed")
+                if not stream:
+                    raise error
+                await self.send_event(writer, error.body())
+                return
+            finish_reason = "length" if task.finish_reason == "length" else "stop"
+            if stream:
+                await self.send_event(
+                    writer, self.chunk(completion_id, created, {},
+                                       finish_reason))
+                writer.write(b"data: [DONE]\n\n")
+                await writer.drain()
+                return
+            await self.send_json(writer, 200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": self.model_name,
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": "".join(content)
+                    },
+                    "finish_reason": finish_reason,
+                }],
+                "usage": {
+                    "prompt_tokens": len(task.prompt_tokens),
+                    "completion_tokens": len(task.output_tokens),
+                    "total_tokens":
+                    len(task.prompt_tokens) + len(task.output_tokens),
+                },
+            })
+        finally:
+            task.cancel()
+            disconnected.cancel()
+
+    async def stream_text(self, task: GenerationTask, events, disconnected):
+        """
+        Yields the post-processed answer of `task` in increments and cancels
+        it once the client is gone or the stop text was generated
+        """
+        detokenizer = IncrementalDetokenizer(self.ov_model.tokenizer)
+        processor = IncrementalResponseProcessor(
+            self.ov_model.engine.adapter.stop_text)
+        while True:
+            event = asyncio.ensure_future(events.get())
+            await asyncio.wait((event, disconnected),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not event.done():
+                event.cancel()
+                task.cancel()
+                raise ConnectionResetError("client disconnected")
+            token = event.result()
+            if token is None:
+                break
+            with self.ov_model.engine.profiler.span("detokenize"):
+                text = processor.feed(detokenizer.add(token))
+            if text:
+                yield text
+            if processor.stopped:
+                task.cancel()
+                return
+        text = processor.flush()
+        if text:
+            yield text
+
+    def chunk(self, completion_id, created, delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": self.model_name,
+            "choices": [{
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }],
+        }
+
+    async def send_headers(self, writer, status: int, content_type: str,
+                           extra_headers=()):
+        headers = [
+            f"HTTP/1.1 {status} {REASONS[status]}",
+            f"Content-Type: {content_type}",
+            "Cache-Control: no-cache",
+            "Connection: close",
+        ]
+        headers.extend(extra_headers)
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def send_event(self, writer, data):
+        writer.write(b"data: " + json.dumps(data, ensure_ascii=False).encode() +
+                     b"\n\n")
+        await writer.drain()
+
+    async def send_json(self, writer, status: int, data, extra_headers=()):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        await self.send_headers(writer, status, "application/json",
+                                [f"Content-Length: {len(body)}", *extra_headers])
+        writer.write(body)
+        await writer.drain()
+
+    async def send_error(self, writer, error: HTTPError):
+        extra_headers = ["Retry-After: 1"] if error.status in (429, 503) else []
+        try:
+            await self.send_json(writer, error.status, error.body(),
+                                 extra_headers)
+        except ConnectionError:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h',
+                        '--help',
+                        action='help',
+                        help='Show this help message and exit.')
+    parser.add_argument('-m',
+                        '--model_path',
+                        required=True,
+                        type=str,
+                        help='Required. model path')
+    parser.add_argument('-d',
+                        '--device',
+                        default='CPU',
+                        required=False,
+                        type=str,
+                        help='Required. device for inference')
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        required=False,
+                        type=str,
+                        help='Optional. address to listen on')
+    parser.add_argument('--port',
+                        default=8000,
+                        required=False,
+                        type=int,
+                        help='Optional. port to listen on')
+    parser.add_argument('-b',
+                        '--max_batch_size',
+                        default=8,
+                        required=False,
+                        type=int,
+                        help='Optional. maximum number of sequences decoded together')
+    parser.add_argument('-q',
+                        '--max_queue_size',
+                        default=32,
+                        required=False,
+                        type=int,
+                        help='Optional. number of waiting requests beyond which new ones get a 429')
+    parser.add_argument('-l',
+                        '--max_sequence_length',
+                        default=256,
+                        required=False,
+                        type=int,
+                        help='Optional. default maximum number of generated tokens per request')
+    parser.add_argument('-kv',
+                        '--kv_pool_size',
+                        default=4096,
+                        required=False,
+                        type=int,
+                        help='Optional. memory budget in MB of the paged KV-cache, batched requests are admitted only while their KV-cache fits into it; 0 disables it')
+    parser.add_argument('-c',
+                        '--cache_dir',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. directory caching the compiled model to cut start-up time')
+    parser.add_argument('-pf',
+                        '--prefill_chunk_size',
+                        default=512,
+                        required=False,
+                        type=int,
+                        help='Optional. longest prompt part prefilled in one inference, long prompts are prefilled between decode steps of running requests')
+    parser.add_argument('--no_mmap',
+                        action='store_true',
+                        help='Optional. read the weights into process memory instead of memory mapping them')
+    parser.add_argument('--profile',
+                        default=None,
+                        required=False,
+                        type=str,
+                        help='Optional. time every generation step and write a Chrome trace to this JSON file')
+    add_runtime_args(parser, 'throughput')
+    args = parser.parse_args()
+    config = RuntimeConfig.from_args(args)
+
+    model_id = args.model_path
+    kv_pool = None
+    if args.kv_pool_size > 0:
+        kv_pool = KVBlockPool(max_bytes=args.kv_pool_size << 20)
+    tokenizer = load_tokenizer(model_id)
+    model_class = next((model_class
+                        for family, model_class in MODEL_CLASSES.items()
+                        if family in model_id), None)
+    if model_class is None:
+        raise NotImplementedError(f"Unsupported model id {model_id!r}")
+    ov_model = model_class(model_id,
+                           args.device,
+                           kv_pool=kv_pool,
+                           cache_dir=args.cache_dir,
+                           mmap=not args.no_mmap,
+                           config=config,
+                           tokenizer=tokenizer)
+    print(f" --- {ov_model.load_timings.report()} --- ")
+
+    server = ChatCompletionServer(ov_model,
+                                  Path(model_id).name,
+                                  max_batch_size=args.max_batch_size,
+                                  max_queue_size=args.max_queue_size,
+                                  max_tokens=args.max_sequence_length)
+    ov_model.engine.profiler.enabled = args.profile is not None
+    ov_model.engine.prefill_chunk_size = args.prefill_chunk_size
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    finally:
+        if args.profile:
+            ov_model.engine.profiler.export_chrome_trace(args.profile)
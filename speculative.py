@@ -0,0 +1,134 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from engine import GenerationEngine, InferRequestPool
+from runtime import RuntimeConfig, load_model
+
+
+class PromptLookupDrafter():
+    """
+    Drafts the tokens that followed the last occurrence of the current
+    n-gram earlier in the context. Costs no inference and works well for
+    answers quoting the prompt, e.g. summaries or code edits.
+    """
+
+    def __init__(self, num_draft_tokens: int = 4, max_ngram_size: int = 3) -> None:
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram_size = max_ngram_size
+
+    def begin(self, prompt_tokens, max_generated_tokens: int):
+        return None
+
+    def propose(self, state, context, max_tokens: int, top_k=20, top_p=0.7,
+                temperature=1):
+        """
+        Returns up to `max_tokens` draft tokens and their distributions,
+        None as the drafts are deterministic
+        """
+        num_tokens = min(self.num_draft_tokens, max_tokens)
+        if num_tokens <= 0:
+            return [], None
+        for ngram_size in range(self.max_ngram_size, 0, -1):
+            if len(context) <= ngram_size:
+                continue
+            windows = sliding_window_view(context[:-1], ngram_size)
+            matches = np.flatnonzero(
+                (windows == context[-ngram_size:]).all(axis=-1))
+            if len(matches):
+                start = matches[-1] + ngram_size
+                return context[start:start + num_tokens].tolist(), None
+        return [], None
+
+    def end(self, state):
+        pass
+
+
+class DraftState():
+    """
+    Per generation state of a `DraftModelDrafter`: the checked out infer
+    request, the KV-cache buffer and the tokens it covers
+    """
+
+    def __init__(self, request, kv_buffer) -> None:
+        self.request = request
+        self.kv_buffer = kv_buffer
+        self.tokens = np.zeros((0, ), dtype=np.int64)
+
+
+class DraftModelDrafter():
+    """
+    Drafts tokens with a small model sharing the tokenizer and KV-cache
+    layout of the target model, e.g. a 1.8B variant of the same family. The
+    draft model keeps its own KV-cache between proposals of a generation and
+    rolls back the positions of drafts the target model rejected.
+    """
+
+    def __init__(self, engine: GenerationEngine, num_draft_tokens: int = 4) -> None:
+        self.engine = engine
+        self.num_draft_tokens = num_draft_tokens
+
+    @classmethod
+    def from_ir(cls,
+                core,
+                ir_model,
+                target: GenerationEngine,
+                device: str = 'CPU',
+                num_draft_tokens: int = 4,
+                config: RuntimeConfig = None):
+        """
+        Reads and compiles the draft model IR with the `core` of the target
+        model, which also applies its cache directory
+        """
+        print(" --- loading draft model --- ")
+        compiled_model, _ = load_model(core, ir_model, device, config=config)
+        requests = InferRequestPool(compiled_model, len(target.requests))
+        engine = GenerationEngine(compiled_model, requests, target.tokenizer,
+                                  target.adapter)
+        if engine.topk_logits:
+            raise ValueError(
+                "the draft model has to be exported without --topk_head")
+        return cls(engine, num_draft_tokens)
+
+    def begin(self, prompt_tokens, max_generated_tokens: int):
+        kv_buffer = self.engine.acquire_kv_buffer(
+            len(prompt_tokens) + max_generated_tokens + self.num_draft_tokens)
+        kv_buffer.load(None, 0)
+        return DraftState(self.engine.requests.acquire(), kv_buffer)
+
+    def propose(self, state: DraftState, context, max_tokens: int, top_k=20,
+                top_p=0.7, temperature=1):
+        """
+        Samples up to `max_tokens` draft tokens, returns them with the
+        `[num_tokens, vocab]` distributions they were drawn from
+        """
+        num_tokens = min(self.num_draft_tokens, max_tokens)
+        if num_tokens <= 0:
+            return [], None
+        # roll back to the part of the context the draft KV-cache still matches
+        length = min(len(state.tokens), len(context) - 1)
+        mismatch = np.flatnonzero(state.tokens[:length] != context[:length])
+        if len(mismatch):
+            length = int(mismatch[0])
+        state.kv_buffer.truncate(length)
+        input_ids = np.asarray(context[length:], dtype=np.int64)[None]
+        tokens, probs = [], []
+        for _ in range(num_tokens):
+            logits, _ = self.engine.forward(input_ids,
+                                            past_length=state.kv_buffer.length,
+                                            kv_buffer=state.kv_buffer,
+                                            request=state.request)
+            prob = self.engine.sampler.probabilities(logits[:, -1],
+                                                     top_k=top_k,
+                                                     top_p=top_p,
+                                                     temperature=temperature)
+            token = self.engine.sampler.sample_probabilities(prob)[0].item()
+            tokens.append(token)
+            probs.append(prob[0])
+            input_ids = np.array([[token]], dtype=np.int64)
+        # the last draft token was not fed to the draft model
+        state.tokens = np.concatenate((context, tokens[:-1])).astype(np.int64)
+        return tokens, np.stack(probs)
+
+    def end(self, state: DraftState):
+        self.engine.requests.release(state.request)
+        self.engine.release_kv_buffer(state.kv_buffer)
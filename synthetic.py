@@ -0,0 +1,360 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import openvino as ov
+from openvino.runtime import opset11 as ops
+
+from utils import add_topk_head, slice_last_token
+
+# ir file stem, KV-cache layout and the input next to input_ids per family
+FAMILIES = {
+    "chatglm2": ("chatglm2", "SBNH", "position_ids"),
+    "qwen": ("qwen", "BSNH", "attention_mask"),
+    "baichuan2": ("baichuan2", "BNSH", "attention_mask"),
+    "internlm": ("internlm", "BNSH", "attention_mask"),
+}
+
+SPECIAL_TOKENS = {
+    "chatglm2": ["</s>", "[gMASK]", "sop"],
+    "qwen": ["<|endoftext|>", "<|im_start|>", "<|im_end|>"],
+    "baichuan2": ["</s>"],
+    "internlm": ["</s>", "<s>", "<eoh>", "<eoa>"],
+}
+
+TOKENIZER_FILE = "synthetic_tokenizer.json"
+
+
+class ByteTokenizer():
+    """
+    Stand-in tokenizer mapping UTF-8 bytes to ids 0-255 and the special
+    tokens of a family to the ids after them. It covers the subset of the
+    HuggingFace tokenizer API the model classes use.
+    """
+
+    def __init__(self, special_tokens, eos_token: str = "</s>") -> None:
+        self.special_tokens = list(special_tokens)
+        self.special_ids = {
+            token: 256 + idx
+            for idx, token in enumerate(self.special_tokens)
+        }
+        self.eos_token = eos_token
+        self.eos_token_id = self.special_ids[eos_token]
+        if "<|im_end|>" in self.special_ids:
+            self.im_end_id = self.special_ids["<|im_end|>"]
+        self.vocab_size = 256 + len(self.special_tokens)
+
+    @classmethod
+    def for_family(cls, family: str):
+        special_tokens = SPECIAL_TOKENS[family]
+        return cls(special_tokens, special_tokens[0])
+
+    @classmethod
+    def from_pretrained(cls, model_path):
+        with open(Path(model_path) / TOKENIZER_FILE) as tokenizer_file:
+            config = json.load(tokenizer_file)
+        return cls(config["special_tokens"], config["eos_token"])
+
+    def save_pretrained(self, model_path):
+        with open(Path(model_path) / TOKENIZER_FILE, "w") as tokenizer_file:
+            json.dump(
+                {
+                    "special_tokens": self.special_tokens,
+                    "eos_token": self.eos_token
+                }, tokenizer_file)
+
+    def encode(self, text: str):
+        ids = []
+        pos = 0
+        while pos < len(text):
+            for token, idx in self.special_ids.items():
+                if text.startswith(token, pos):
+                    ids.append(idx)
+                    pos += len(token)
+                    break
+            else:
+                ids.extend(text[pos].encode("utf-8"))
+                pos += 1
+        return ids
+
+    def __call__(self, texts, return_tensors="np", **kwargs):
+        input_ids = [self.encode(text) for text in texts]
+        return {"input_ids": np.array(input_ids, dtype=np.int64)}
+
+    def decode(self, ids, skip_special_tokens=False):
+        text = ""
+        pending = bytearray()
+        for idx in ids:
+            idx = int(idx)
+            if idx < 256:
+                pending.append(idx)
+                continue
+            text += pending.decode("utf-8", errors="replace")
+            pending = bytearray()
+            if not skip_special_tokens and idx - 256 < len(self.special_tokens):
+                text += self.special_tokens[idx - 256]
+        return text + pending.decode("utf-8", errors="replace")
+
+
+def is_synthetic(model_path):
+    return (Path(model_path) / TOKENIZER_FILE).is_file()
+
+
+def load_tokenizer(model_path):
+    """
+    The stand-in tokenizer of a synthetic model, None for exported ones
+    """
+    if is_synthetic(model_path):
+        return ByteTokenizer.from_pretrained(model_path)
+    return None
+
+
+def _random_constant(rng, shape, scale=0.5):
+    values = rng.standard_normal(shape) * scale
+    return ops.constant(values.astype(np.float32))
+
+
+def _indices(values):
+    return ops.constant(np.array(values, dtype=np.int64))
+
+
+def build_model(family: str,
+                num_layers: int = 2,
+                hidden_size: int = 64,
+                num_heads: int = 4,
+                vocab_size: int = 512,
+                seed: int = 0,
+                last_token_logits: bool = False,
+                topk_head: int = None,
+                position_ids: bool = False):
+    """
+    Builds a random weight decoder with the inputs, outputs and KV-cache
+    layout of an exported model of `family`: `input_ids`, `position_ids` or
+    `attention_mask`, `past_key_values.{i}.key/value` in and `logits`,
+    `present.{i}.key/value` out. Every layer is rotary self attention, so
+    the outputs depend on positions, masking and the KV-cache the same way
+    as in the real models. `last_token_logits` slices the logits like
+    `export_ir.py --last_token_logits` and `topk_head` adds the TopK head of
+    `export_ir.py --topk_head`. `position_ids` adds that input
+    next to the `attention_mask` of a family, like the Baichuan2 and
+    InternLM exports, and takes the rotary positions from it.
+    """
+    _, layout, extra_input = FAMILIES[family]
+    rng = np.random.default_rng(seed)
+    head_dim = hidden_size // num_heads
+    kv_shape = {
+        "SBNH": [-1, -1, num_heads, head_dim],
+        "BSNH": [-1, -1, num_heads, head_dim],
+        "BNSH": [-1, num_heads, -1, head_dim],
+    }[layout]
+    seq_axis = layout.index("S")
+    # permutation from [batch, heads, seq, head_dim] to the layout
+    to_layout = ["BNSH".index(axis) for axis in layout]
+    from_layout = np.argsort(to_layout).tolist()
+
+    input_ids = ops.parameter([-1, -1], ov.Type.i64, name="input_ids")
+    extra = ops.parameter([-1, -1], ov.Type.i64, name=extra_input)
+    past = [(ops.parameter(kv_shape, ov.Type.f32,
+                           name=f"past_key_values.{i}.key"),
+             ops.parameter(kv_shape, ov.Type.f32,
+                           name=f"past_key_values.{i}.value"))
+            for i in range(num_layers)]
+    past_params = [param for pair in past for param in pair]
+    if extra_input == "position_ids":
+        params = [input_ids, extra] + past_params
+    else:
+        params = [input_ids] + past_params + [extra]
+    row_positions = None
+    if position_ids and extra_input == "attention_mask":
+        row_positions = ops.parameter([-1, -1], ov.Type.i64,
+                                      name="position_ids")
+        params.append(row_positions)
+
+    zero, one = _indices([0]), _indices([1])
+    seq_len = ops.gather(ops.shape_of(input_ids), one, zero)
+    past_len = ops.gather(ops.shape_of(past[0][0]), _indices([seq_axis]),
+                          zero)
+    query_positions = ops.add(
+        ops.range(ops.constant(np.int64(0)), ops.squeeze(seq_len, zero),
+                  ops.constant(np.int64(1)), ov.Type.i64), past_len)
+    if extra_input == "position_ids":
+        positions = extra
+    elif row_positions is not None:
+        positions = row_positions
+    else:
+        positions = ops.unsqueeze(query_positions, zero)
+    # rotary tables broadcasting over [batch, heads, seq, head_dim / 2]
+    inv_freq = 1.0 / (10000**(np.arange(head_dim // 2) / (head_dim // 2)))
+    angles = ops.multiply(
+        ops.convert(ops.unsqueeze(positions, _indices([1, 3])), "f32"),
+        ops.constant(inv_freq.astype(np.float32)))
+    cos, sin = ops.cos(angles), ops.sin(angles)
+
+    def rotate(x):
+        x1, x2 = ops.split(x, ops.constant(np.int64(-1)), 2).outputs()
+        return ops.concat([
+            ops.subtract(ops.multiply(x1, cos), ops.multiply(x2, sin)),
+            ops.add(ops.multiply(x1, sin), ops.multiply(x2, cos))
+        ], -1)
+
+    hidden = ops.gather(_random_constant(rng, [vocab_size, hidden_size]),
+                        input_ids, ops.constant(np.int64(0)))
+    key_positions = ops.range(ops.constant(np.int64(0)),
+                              ops.squeeze(ops.add(past_len, seq_len), zero),
+                              ops.constant(np.int64(1)), ov.Type.i64)
+    # causal [seq, past + seq] mask, combined with the padding mask
+    allowed = ops.less_equal(ops.unsqueeze(key_positions, zero),
+                             ops.unsqueeze(query_positions, one))
+    if extra_input == "attention_mask":
+        padding = ops.not_equal(extra, ops.constant(np.int64(0)))
+        allowed = ops.logical_and(allowed,
+                                  ops.unsqueeze(padding, _indices([1, 2])))
+    split_heads = _indices([0, 0, num_heads, head_dim])
+    merge_heads = _indices([0, 0, hidden_size])
+    to_heads = _indices([0, 2, 1, 3])
+    scale = 1 / np.sqrt(hidden_size)
+    presents = []
+    for past_key, past_value in past:
+        query, key, value = [
+            ops.transpose(
+                ops.reshape(
+                    ops.matmul(
+                        hidden,
+                        _random_constant(rng, [hidden_size, hidden_size],
+                                         scale), False, False), split_heads,
+                    True), to_heads) for _ in range(3)
+        ]
+        query, key = rotate(query), rotate(key)
+        present_key = ops.concat(
+            [past_key, ops.transpose(key, _indices(to_layout))], seq_axis)
+        present_value = ops.concat(
+            [past_value, ops.transpose(value, _indices(to_layout))], seq_axis)
+        scores = ops.multiply(
+            ops.matmul(query,
+                       ops.transpose(present_key, _indices(from_layout)),
+                       False, True),
+            ops.constant(np.float32(1 / np.sqrt(head_dim))))
+        scores = ops.select(allowed, scores, ops.constant(np.float32(-1e9)))
+        attention = ops.matmul(
+            ops.softmax(scores, -1),
+            ops.transpose(present_value, _indices(from_layout)), False, False)
+        attention = ops.reshape(ops.transpose(attention, to_heads),
+                                merge_heads, True)
+        hidden = ops.add(
+            hidden,
+            ops.tanh(
+                ops.matmul(
+                    attention,
+                    _random_constant(rng, [hidden_size, hidden_size], scale),
+                    False, False)))
+        presents.extend([present_key, present_value])
+    lm_head = _random_constant(rng, [hidden_size, vocab_size], 2 * scale)
+    logits = ops.matmul(hidden, lm_head, False, False)
+
+    model = ov.Model([logits] + presents, params, family)
+    names = ["logits"]
+    for i in range(num_layers):
+        names.extend([f"present.{i}.key", f"present.{i}.value"])
+    for output, name in zip(model.outputs, names):
+        output.get_tensor().set_names({name})
+    if last_token_logits:
+        slice_last_token(model)
+    if topk_head:
+        model = add_topk_head(model, topk_head)
+    return model
+
+
+def export_model(family: str, output_dir, **kwargs):
+    """
+    Saves a synthetic IR and its stand-in tokenizer to `output_dir`, which
+    the model class of `family` then loads like an exported model
+    """
+    tokenizer = ByteTokenizer.for_family(family)
+    if kwargs.get("vocab_size", 512) < tokenizer.vocab_size:
+        raise ValueError(f"vocab_size has to be at least {tokenizer.vocab_size}")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    model = build_model(family, **kwargs)
+    ov.save_model(model, output_dir / f"{FAMILIES[family][0]}.xml")
+    tokenizer.save_pretrained(output_dir)
+    return output_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h',
+                        '--help',
+                        action='help',
+                        help='Show this help message and exit.')
+    parser.add_argument('-f',
+                        '--family',
+                        default=list(FAMILIES),
+                        nargs='+',
+                        choices=tuple(FAMILIES),
+                        help='Optional. model families to build')
+    parser.add_argument('-o',
+                        '--output',
+                        default='./synthetic',
+                        required=False,
+                        type=str,
+                        help='Optional. directory holding one model directory per family')
+    parser.add_argument('-l',
+                        '--num_layers',
+                        default=2,
+                        required=False,
+                        type=int,
+                        help='Optional. number of decoder layers')
+    parser.add_argument('-hs',
+                        '--hidden_size',
+                        default=64,
+                        required=False,
+                        type=int,
+                        help='Optional. hidden size')
+    parser.add_argument('-nh',
+                        '--num_heads',
+                        default=4,
+                        required=False,
+                        type=int,
+                        help='Optional. number of attention heads')
+    parser.add_argument('-v',
+                        '--vocab_size',
+                        default=512,
+                        required=False,
+                        type=int,
+                        help='Optional. vocabulary size, at least 256 plus the special tokens')
+    parser.add_argument('-s',
+                        '--seed',
+                        default=0,
+                        required=False,
+                        type=int,
+                        help='Optional. seed of the random weights')
+    parser.add_argument('-lt',
+                        '--last_token_logits',
+                        action='store_true',
+                        help='Optional. compute the logits of the last position only')
+    parser.add_argument('-k',
+                        '--topk_head',
+                        default=None,
+                        required=False,
+                        type=int,
+                        help='Optional. return only the k largest logits and their token ids')
+    parser.add_argument('-p',
+                        '--position_ids',
+                        action='store_true',
+                        help='Optional. take position_ids next to the attention_mask, giving every batch row its own positions')
+    args = parser.parse_args()
+
+    for family in args.family:
+        print(f" --- building synthetic {family} --- ")
+        output_dir = export_model(family,
+                                  Path(args.output) / family,
+                                  num_layers=args.num_layers,
+                                  hidden_size=args.hidden_size,
+                                  num_heads=args.num_heads,
+                                  vocab_size=args.vocab_size,
+                                  seed=args.seed,
+                                  last_token_logits=args.last_token_logits,
+                                  topk_head=args.topk_head,
+                                  position_ids=args.position_ids)
+        print(f"saved to {output_dir}")
@@ -1,9 +1,25 @@
+import json
 import numpy as np
 import re
+import threading
+from pathlib import Path
+from openvino.runtime import Core, Model
+from openvino.runtime import opset11 as ops
+
+TRAINING_TIME_MARKER = "[[训练时间]]"
+TRAINING_TIME = "2023年"
+COMPRESSION_MODES = ("int8", "int4_sym", "int4_asym")
+COMPRESSION_SUMMARY_FILE = "compression_summary.json"
+PUNKTS = {",": "，", "!": "！", ":": "：", ";": "；", "?": "？"}
+
+
+def _is_cjk(char: str):
+    return char is not None and "\u4e00" <= char <= "\u9fff"
+
 
 def process_response(response: str):
     response = response.strip()
-    response = response.replace("[[训练时间]]", "2023年")
+    response = response.replace(TRAINING_TIME_MARKER, TRAINING_TIME)
     punkts = [
         [",", "，"],
         ["!", "！"],
@@ -19,24 +35,304 @@ def process_response(response: str):
     return response
 
 
-def sample_next_token(logits: np.ndarray, top_k=20, top_p=0.7, temperature=1):
-    # softmax with temperature
-    logits = logits - np.max(logits, axis=-1, keepdims=True)
-    exp_logits = np.exp(logits / temperature)
-    probs = exp_logits / np.sum(exp_logits)
+class IncrementalDetokenizer():
+    """
+    Decodes generated tokens one at a time. Only the tokens since the last
+    emitted text plus a small lookback window are decoded, so SentencePiece
+    word boundaries and multi-byte characters split over several tokens come
+    out the same as when decoding the whole sequence.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=False) -> None:
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens = []
+        # tokens[prefix_offset:read_offset] is the lookback window
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, tokens):
+        return self.tokenizer.decode(
+            tokens, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_id: int):
+        """
+        Returns the text added by `token_id`, empty while a character is
+        still incomplete
+        """
+        self.tokens.append(token_id)
+        prefix_text = self._decode(
+            self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.tokens[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+
+class IncrementalResponseProcessor():
+    """
+    Streaming version of `process_response`. Text that could still change
+    once more text arrives is held back: leading and trailing whitespace,
+    punctuation whose right neighbour is unknown and partial matches of the
+    replaced marker or of `stop_text`, after which the response ends.
+    """
+
+    def __init__(self, stop_text: str = None) -> None:
+        self.stop_text = stop_text
+        self.stopped = False
+        self._pending = ""
+        self._last_char = None
+        self._started = False
+
+    def _held_suffix(self, text: str):
+        held = 0
+        for pattern in (TRAINING_TIME_MARKER, self.stop_text):
+            if pattern is None:
+                continue
+            for length in range(len(pattern) - 1, held, -1):
+                if text.endswith(pattern[:length]):
+                    held = length
+                    break
+        return held
+
+    def _normalize(self, text: str, next_char: str = None):
+        chars = list(text)
+        for idx, char in enumerate(text):
+            if char not in PUNKTS:
+                continue
+            prev_char = text[idx - 1] if idx else self._last_char
+            following = text[idx + 1] if idx + 1 < len(text) else next_char
+            if _is_cjk(prev_char) or _is_cjk(following):
+                chars[idx] = PUNKTS[char]
+        if text:
+            self._last_char = text[-1]
+        return "".join(chars)
+
+    def feed(self, text: str):
+        """
+        Returns the part of the response that became final with `text`
+        """
+        if self.stopped:
+            return ""
+        text = self._pending + text
+        self._pending = ""
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._started = True
+        if self.stop_text is not None and self.stop_text in text:
+            self._pending = text[:text.index(self.stop_text)]
+            self.stopped = True
+            return self.flush()
+        text = text.replace(TRAINING_TIME_MARKER, TRAINING_TIME)
+        end = len(text) - self._held_suffix(text)
+        while end > 0 and (text[end - 1].isspace() or text[end - 1] in PUNKTS):
+            end -= 1
+        self._pending = text[end:]
+        return self._normalize(text[:end],
+                               text[end] if end < len(text) else None)
 
-    # top k
-    top_k_idx = np.argsort(-probs)[:top_k]
-    top_k_probs = probs[top_k_idx]
+    def flush(self):
+        """
+        Returns the held back rest once the response is complete
+        """
+        text = self._pending.rstrip()
+        self._pending = ""
+        return self._normalize(
+            text.replace(TRAINING_TIME_MARKER, TRAINING_TIME))
 
-    # top p
-    cumsum_probs = np.cumsum(top_k_probs)
-    top_k_probs[(cumsum_probs - top_k_probs) > top_p] = 0.0
-    top_k_probs = top_k_probs / np.sum(top_k_probs)
 
-    # sample
-    next_token = np.random.choice(top_k_idx, size=1, p=top_k_probs)
-    return next_token[0].item()
+class TopKLogits():
+    """
+    Output of a model exported with a TopK head: the `values` and token
+    `indices` of the k largest logits of every position, both shaped
+    `[..., k]` in descending order. Indexing applies to both, so loops
+    reading `logits[:, -1]` work unchanged.
+    """
+
+    def __init__(self, values: np.ndarray, indices: np.ndarray) -> None:
+        self.values = values
+        self.indices = indices
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __getitem__(self, index):
+        return TopKLogits(self.values[index], self.indices[index])
+
+    def copy(self):
+        return TopKLogits(self.values.copy(), self.indices.copy())
+
+
+class BatchSampler():
+    """
+    Top-k / top-p sampling for every row of `[batch, vocab]` logits with
+    per-row temperature, top_k and top_p. Only the top_k candidates are
+    partitioned out instead of sorting the whole vocabulary, the softmax
+    scratch buffer is reused between calls and randomness comes from a
+    seedable `np.random.Generator`. `TopKLogits` rows are sampled from their
+    k candidates, normalised over those instead of the whole vocabulary.
+    """
+
+    def __init__(self, seed=None) -> None:
+        self.seed(seed)
+        self._buffer = None
+        self._lock = threading.Lock()
+
+    def seed(self, seed=None):
+        self.generator = np.random.default_rng(seed)
+
+    def _scratch(self, shape):
+        if self._buffer is None or self._buffer.size < np.prod(shape):
+            self._buffer = np.empty(np.prod(shape), dtype=np.float32)
+        return self._buffer[:np.prod(shape)].reshape(shape)
+
+    def _filter(self, logits: np.ndarray, top_k, top_p, temperature):
+        """
+        Returns the candidate token ids of every row in descending order and
+        their probabilities, zeroed outside of top_k / top_p
+        """
+        if isinstance(logits, TopKLogits):
+            return self._filter_top_k(logits, top_k, top_p, temperature)
+        batch_size, vocab_size = logits.shape
+        top_k = np.minimum(
+            np.broadcast_to(np.asarray(top_k, dtype=np.int64), (batch_size, )),
+            vocab_size)
+        top_p = np.broadcast_to(np.asarray(top_p, dtype=np.float32),
+                                (batch_size, ))[:, None]
+        temperature = np.broadcast_to(
+            np.asarray(temperature, dtype=np.float32), (batch_size, ))[:, None]
+        max_k = int(top_k.max())
+        # softmax normaliser over the full vocabulary
+        max_logits = np.max(logits, axis=-1, keepdims=True)
+        scaled = self._scratch((batch_size, vocab_size))
+        np.subtract(logits, max_logits, out=scaled)
+        np.divide(scaled, temperature, out=scaled)
+        np.exp(scaled, out=scaled)
+        normaliser = np.sum(scaled, axis=-1, keepdims=True)
+
+        # top k, only the k largest entries get sorted
+        if max_k < vocab_size:
+            top_k_idx = np.argpartition(-logits, max_k - 1, axis=-1)[:, :max_k]
+        else:
+            top_k_idx = np.broadcast_to(np.arange(vocab_size),
+                                        (batch_size, vocab_size))
+        top_k_probs = np.take_along_axis(scaled, top_k_idx, axis=-1)
+        order = np.argsort(-top_k_probs, axis=-1, kind="stable")
+        top_k_idx = np.take_along_axis(top_k_idx, order, axis=-1)
+        top_k_probs = np.take_along_axis(top_k_probs, order,
+                                         axis=-1) / normaliser
+        top_k_probs[np.arange(max_k)[None] >= top_k[:, None]] = 0.0
+
+        # top p
+        cumsum_probs = np.cumsum(top_k_probs, axis=-1)
+        top_k_probs[(cumsum_probs - top_k_probs) > top_p] = 0.0
+        return top_k_idx, top_k_probs
+
+    def _filter_top_k(self, logits: TopKLogits, top_k, top_p, temperature):
+        batch_size, num_candidates = logits.shape
+        top_k = np.minimum(
+            np.broadcast_to(np.asarray(top_k, dtype=np.int64), (batch_size, )),
+            num_candidates)
+        top_p = np.broadcast_to(np.asarray(top_p, dtype=np.float32),
+                                (batch_size, ))[:, None]
+        temperature = np.broadcast_to(
+            np.asarray(temperature, dtype=np.float32), (batch_size, ))[:, None]
+        # values are sorted, the first one is the maximum
+        top_k_probs = np.exp(
+            (logits.values - logits.values[:, :1]) / temperature)
+        top_k_probs /= np.sum(top_k_probs, axis=-1, keepdims=True)
+        top_k_probs[np.arange(num_candidates)[None] >= top_k[:, None]] = 0.0
+        cumsum_probs = np.cumsum(top_k_probs, axis=-1)
+        top_k_probs[(cumsum_probs - top_k_probs) > top_p] = 0.0
+        return logits.indices, top_k_probs
+
+    def _draw(self, probs: np.ndarray):
+        """
+        Samples one column of every row of unnormalised `probs` by inverting
+        its cumulative distribution
+        """
+        cumsum_probs = np.cumsum(probs, axis=-1)
+        threshold = self.generator.random(
+            (probs.shape[0], 1)) * cumsum_probs[:, -1:]
+        return np.argmax(cumsum_probs > threshold, axis=-1)
+
+    def sample(self, logits: np.ndarray, top_k=20, top_p=0.7, temperature=1):
+        batch_size = logits.shape[0]
+        with self._lock:
+            top_k_idx, top_k_probs = self._filter(logits, top_k, top_p,
+                                                  temperature)
+            choice = self._draw(top_k_probs)
+        return top_k_idx[np.arange(batch_size), choice]
+
+    def probabilities(self,
+                      logits: np.ndarray,
+                      top_k=20,
+                      top_p=0.7,
+                      temperature=1):
+        """
+        Dense `[batch, vocab]` distribution `sample` draws from
+        """
+        probs = np.zeros(logits.shape, dtype=np.float32)
+        with self._lock:
+            top_k_idx, top_k_probs = self._filter(logits, top_k, top_p,
+                                                  temperature)
+        np.put_along_axis(probs, top_k_idx, top_k_probs, axis=-1)
+        probs /= probs.sum(axis=-1, keepdims=True)
+        return probs
+
+    def sample_probabilities(self, probs: np.ndarray):
+        with self._lock:
+            return self._draw(probs)
+
+    def verify(self,
+               logits: np.ndarray,
+               draft_tokens,
+               draft_probs: np.ndarray = None,
+               top_k=20,
+               top_p=0.7,
+               temperature=1):
+        """
+        Speculative sampling: `logits` are the `[len(draft_tokens) + 1,
+        vocab]` target model logits of a verification pass. Draft tokens are
+        accepted with probability min(1, p / q) and the first rejected one
+        is resampled from the residual max(0, p - q), so the returned tokens
+        follow the target distribution. `draft_probs` are the `[k, vocab]`
+        draft distributions, None for deterministic drafts. Returns the
+        accepted tokens plus one token sampled by the target model.
+        """
+        probs = self.probabilities(logits, top_k, top_p, temperature)
+        with self._lock:
+            accept = self.generator.random(len(draft_tokens))
+        tokens = []
+        for idx, token in enumerate(draft_tokens):
+            draft_prob = 1.0 if draft_probs is None else draft_probs[idx, token]
+            if accept[idx] * draft_prob < probs[idx, token]:
+                tokens.append(token)
+                continue
+            if draft_probs is None:
+                residual = probs[idx].copy()
+                residual[token] = 0.0
+            else:
+                residual = np.maximum(probs[idx] - draft_probs[idx], 0.0)
+            if residual.sum() <= 0:
+                residual = probs[idx]
+            return tokens + [self.sample_probabilities(residual[None])[0].item()]
+        return tokens + [self.sample_probabilities(probs[-1:])[0].item()]
+
+
+_default_sampler = BatchSampler()
+
+
+def sample_next_token(logits: np.ndarray, top_k=20, top_p=0.7, temperature=1):
+    return _default_sampler.sample(logits[None],
+                                   top_k=top_k,
+                                   top_p=top_p,
+                                   temperature=temperature)[0].item()
 
 
 def flattenize_inputs(inputs):
@@ -51,4 +347,121 @@ def flattenize_inputs(inputs):
             flatten_inputs.extend(flattenize_inputs(input_data))
         else:
             flatten_inputs.append(input_data)
-    return flatten_inputs
\ No newline at end of file
+    return flatten_inputs
+
+def slice_last_token(ov_model, seq_axis: int = 1):
+    """
+    Makes the lm_head of an exported model project the hidden state of the
+    last position only, so `logits` become `[batch, 1, vocab]` and prefill
+    no longer computes and returns the logits of every prompt token.
+    `seq_axis` is the sequence axis of the hidden states.
+    """
+    node = ov_model.output("logits").get_node()
+    while node.get_type_name() != "MatMul":
+        if node.get_input_size() == 0:
+            raise ValueError("logits are not computed by a MatMul")
+        node = node.input_value(0).get_node()
+    axis = ops.constant(np.int64(seq_axis))
+    last_hidden = ops.unsqueeze(
+        ops.gather(node.input_value(0), ops.constant(np.int64(-1)), axis),
+        axis)
+    node.input(0).replace_source_output(last_hidden.output(0))
+    ov_model.validate_nodes_and_infer_types()
+    return ov_model
+
+
+def add_topk_head(ov_model, k: int):
+    """
+    Replaces the `logits` output by the `topk_logits` and `topk_indices` of
+    the `k` largest logits, so the runtime reads back `k` values per
+    position instead of the whole vocabulary. Returns the new model.
+    """
+    logits = ov_model.output("logits").get_node().input_value(0)
+    topk = ops.topk(logits,
+                    ops.constant(np.int64(k)),
+                    axis=-1,
+                    mode="max",
+                    sort="value",
+                    index_element_type="i64")
+    values, indices = topk.outputs()
+    values.get_tensor().set_names({"topk_logits"})
+    indices.get_tensor().set_names({"topk_indices"})
+    results = [ops.result(values), ops.result(indices)]
+    for result in ov_model.get_results():
+        if "logits" not in result.output(0).get_names():
+            results.append(result)
+    return Model(results, ov_model.get_parameters(),
+                 ov_model.get_friendly_name())
+
+
+def compress_model(ov_model,
+                   mode: str = "int8",
+                   group_size: int = 128,
+                   ratio: float = 1.0):
+    """
+    Compresses the weights of a converted model with NNCF. `int8` is
+    per-channel, the `int4_*` modes quantize groups of `group_size` weights
+    of a `ratio` of the layers to 4 bits and keep the rest in INT8.
+    """
+    from nncf import CompressWeightsMode, compress_weights
+    if mode == "int8":
+        return compress_weights(ov_model, mode=CompressWeightsMode.INT8)
+    return compress_weights(ov_model,
+                            mode=CompressWeightsMode[mode.upper()],
+                            group_size=group_size,
+                            ratio=ratio)
+
+
+def _weight_constant(node, index):
+    source = node.input_value(index).get_node()
+    # weight decompression subgraph of compressed or FP16 weights
+    while source.get_type_name() in ("Convert", "Subtract", "Multiply",
+                                     "Reshape", "Transpose"):
+        source = source.input_value(0).get_node()
+    if source.get_type_name() == "Constant":
+        return source
+    return None
+
+
+def weight_precisions(ov_model):
+    """
+    Element type of the stored weights of every MatMul and of compressed
+    embeddings, by node name
+    """
+    precisions = {}
+    for node in ov_model.get_ordered_ops():
+        if node.get_type_name() == "MatMul":
+            weight = _weight_constant(node, 1)
+        elif node.get_type_name() == "Gather":
+            weight = _weight_constant(node, 0)
+            if weight is not None and weight.get_element_type().is_real():
+                weight = None
+        else:
+            continue
+        if weight is not None:
+            precisions[node.get_friendly_name()] = (
+                weight.get_element_type().get_type_name())
+    return precisions
+
+
+def write_compression_summary(ir_model, **options):
+    """
+    Writes the size of a saved IR and the precision of its weights to
+    `compression_summary.json` next to it, together with the compression
+    `options` used
+    """
+    ir_model = Path(ir_model)
+    precisions = weight_precisions(Core().read_model(ir_model))
+    counts = {}
+    for precision in precisions.values():
+        counts[precision] = counts.get(precision, 0) + 1
+    summary = dict(options)
+    summary.update({
+        "ir_size_mb": ir_model.with_suffix(".bin").stat().st_size / (1 << 20),
+        "layer_precisions": counts,
+        "layers": precisions,
+    })
+    summary_path = ir_model.parent / COMPRESSION_SUMMARY_FILE
+    with open(summary_path, "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    return summary